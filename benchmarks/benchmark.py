@@ -0,0 +1,274 @@
+"""
+Benchmark the Moppina library against synthetic libraries.
+
+Usage::
+
+    python benchmarks/benchmark.py --sizes 10000 100000 --output bench.json
+
+For every library size a fresh database is created in a temporary
+directory, filled with generated tracks and then used to time the
+``MoppinaLibrary`` operations. The timings (in seconds) are written as
+JSON, so that the results of different releases can be compared.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import itertools
+import json
+import logging
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from mopidy.compat import configparser
+from mopidy.models import Album, Artist, Track
+
+import peewee
+
+import mopidy_local_moppina
+from mopidy_local_moppina import Extension
+from mopidy_local_moppina.library import MoppinaLibrary
+
+
+GENRES = ['Rock', 'Pop', 'Jazz', 'Blues', 'Classical', 'Electronic',
+          'Folk', 'Hip-Hop', 'Metal', 'Soul', 'Reggae', 'Country']
+
+WORDS = ['love', 'night', 'blue', 'fire', 'heart', 'river', 'dream',
+         'light', 'song', 'road', 'rain', 'star', 'time', 'home', 'gold',
+         'stone', 'summer', 'shadow', 'city', 'moon', 'wild', 'silent',
+         'electric', 'broken', 'golden', 'last', 'little', 'lonely']
+
+
+def _title(rnd, words=3):
+    return ' '.join(rnd.choice(WORDS) for _ in range(words)).title()
+
+
+def generate_tracks(count, albums_per_artist=5, tracks_per_album=12,
+                    seed=0):
+    """
+    Generate ``count`` tracks grouped in albums of ``tracks_per_album``
+    tracks, each album artist having ``albums_per_artist`` albums. About
+    one track in five features another artist and one in ten has a
+    composer.
+    """
+    rnd = random.Random(seed)
+    album_count = max(1, count // tracks_per_album)
+    artist_count = max(1, album_count // albums_per_artist)
+    artists = [Artist(uri='local:artist:md5:%08d' % i,
+                      name='%s %d' % (_title(rnd, 2), i))
+               for i in range(artist_count)]
+    albums = [Album(uri='local:album:md5:%08d' % i,
+                    name='%s %d' % (_title(rnd), i),
+                    artists=[artists[i % artist_count]],
+                    num_tracks=tracks_per_album)
+              for i in range(album_count)]
+    for i in range(count):
+        album = albums[i % album_count]
+        track_artists = list(album.artists)
+        if rnd.random() < 0.2:
+            track_artists.append(rnd.choice(artists))
+        composers = [rnd.choice(artists)] if rnd.random() < 0.1 else []
+        yield Track(uri='local:track:%s/%08d.mp3' % (album.uri[12:], i),
+                    name='%s %d' % (_title(rnd), i),
+                    album=album,
+                    artists=track_artists,
+                    composers=composers,
+                    genre=rnd.choice(GENRES),
+                    track_no=i // album_count + 1,
+                    date='%d-01-01' % rnd.randint(1960, 2018),
+                    length=rnd.randint(60000, 600000),
+                    last_modified=i)
+
+
+def default_config(data_dir, **overrides):
+    ext = Extension()
+    parser = configparser.RawConfigParser()
+    parser.readfp(io.StringIO('%s' % ext.get_default_config()))
+    values = dict(parser.items(ext.ext_name))
+    values.update((k, '%s' % v) for k, v in overrides.items())
+    ext_config, errors = ext.get_config_schema().deserialize(values)
+    if errors:
+        raise ValueError('Invalid benchmark config: %s' % errors)
+    return {
+        'core': {'data_dir': data_dir},
+        'local': {'media_dir': data_dir},
+        ext.ext_name: ext_config
+    }
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+        'repeat': repeat
+    }
+
+
+def _cold(library, func, *args, **kwargs):
+    """Call ``func`` with the library result caches emptied."""
+    def call():
+        library._search_cache.clear()
+        library._distinct_cache.clear()
+        return func(*args, **kwargs)
+    return call
+
+
+def _first_ref(library, uri):
+    return next(iter(library.browse(uri)), None)
+
+
+def bench_library(size, repeat, **config):
+    data_dir = tempfile.mkdtemp(prefix='moppina-bench-')
+    results = {}
+    try:
+        library = MoppinaLibrary(default_config(data_dir, **config))
+        tracks = generate_tracks(size)
+
+        start = time.time()
+        for track in tracks:
+            library.add(track)
+        library.flush()
+        elapsed = time.time() - start
+        results['scan'] = {
+            'seconds': elapsed,
+            'tracks_per_second': size / elapsed
+        }
+
+        results['begin'] = timeit(lambda: list(library.begin()), 1)
+        results['load'] = timeit(library.load, repeat)
+
+        artist_uri = 'local:artist:md5:%08d' % 0
+        album = _first_ref(library, artist_uri)
+        uris = {
+            'root': library.ROOT_DIRECTORY_URI,
+            'artists': 'local:artists',
+            'albums': 'local:albums',
+            'tracks': 'local:tracks',
+            'genres': 'local:genres',
+            'years': 'local:years',
+            'artist': artist_uri,
+            'album': album.uri if album else 'local:album:md5:%08d' % 0,
+        }
+        for level in ['artists', 'albums', 'tracks']:
+            bucket = _first_ref(library, 'local:%s?initial=S' % level)
+            if bucket is not None and bucket.type == 'directory':
+                uris['%s_page' % level] = bucket.uri
+        results['browse'] = dict(
+            (level, timeit(lambda: library.browse(uri), repeat))
+            for level, uri in uris.items())
+
+        track = next(library.begin())
+        track_artist = next(iter(track.album.artists))
+        results['lookup'] = dict(
+            (kind, timeit(lambda: library.lookup(uri), repeat))
+            for kind, uri in [('track', track.uri),
+                              ('album', track.album.uri),
+                              ('artist', artist_uri)])
+        playlist = [t.uri for t in itertools.islice(library.begin(), 2000)]
+        results['lookup']['playlist_2000'] = timeit(
+            lambda: [library.lookup(uri) for uri in playlist], repeat)
+        results['lookup']['lookup_many_2000'] = timeit(
+            lambda: library.lookup_many(playlist), repeat)
+
+        queries = {
+            'exact_artist': ({'artist': [track_artist.name]},
+                             True, False),
+            'exact_any': ({'any': [track.genre]}, True, False),
+            'fts_any': ({'any': [WORDS[0]]}, False, False),
+            'fts_fields': ({'track_name': [WORDS[1]],
+                            'genre': [track.genre]}, False, False),
+            'fts_prefix': ({'any': [WORDS[2][:3]]}, False, True),
+        }
+        results['search'] = dict(
+            (name, timeit(_cold(library, library.search, query,
+                                exact=exact, prefix=prefix), repeat))
+            for name, (query, exact, prefix) in queries.items())
+        results['search']['cached'] = timeit(
+            lambda: library.search(queries['fts_any'][0]), repeat)
+
+        results['get_distinct'] = dict(
+            (field, timeit(_cold(library, library.get_distinct, field,
+                                 query), repeat))
+            for field, query in [('artist', None), ('albumartist', None),
+                                 ('album', None), ('genre', None),
+                                 ('date', {'genre': [track.genre]})])
+
+        # Remove a tenth of the tracks, closing runs the orphan sweep
+        removed = [t.uri for t in library.begin()][::10]
+        start = time.time()
+        for uri in removed:
+            library.remove(uri)
+        library.close()
+        results['remove'] = {'seconds': time.time() - start}
+
+        # Restart on the now current database
+        library = MoppinaLibrary(default_config(data_dir, **config))
+        results['startup'] = dict(library.stats()['startup'])
+        start = time.time()
+        library.close()
+        results['startup']['close_ms'] = (time.time() - start) * 1000
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='number of tracks of the generated libraries')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs of every read operation')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--background-writer', action='store_true',
+                        help='write the scanned tracks from a thread')
+    parser.add_argument('--output', default='-',
+                        help='JSON results file, default to stdout')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+    config = {}
+    if args.batch_size:
+        config['batch_size'] = args.batch_size
+    if args.background_writer:
+        config['background_writer'] = 'true'
+
+    report = {
+        'version': mopidy_local_moppina.__version__,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'peewee': peewee.__version__,
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'config': config,
+        'results': {}
+    }
+    for size in args.sizes:
+        logging.warning('Benchmark a library of %d tracks', size)
+        report['results'][str(size)] = bench_library(size, args.repeat,
+                                                     **config)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
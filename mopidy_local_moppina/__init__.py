@@ -24,6 +24,26 @@ class Extension(ext.Extension):
 
     def get_config_schema(self):
         schema = super(Extension, self).get_config_schema()
+        schema['batch_size'] = config.Integer(minimum=1)
+        schema['browse_limit'] = config.Integer(minimum=2)
+        schema['search_prefix'] = config.Boolean()
+        schema['search_cache_size'] = config.Integer(minimum=1)
+        schema['model_cache_size'] = config.Integer(minimum=1)
+        schema['instrumentation'] = config.Boolean()
+        schema['slow_query_threshold'] = config.Integer(minimum=0)
+        schema['cache_size'] = config.Integer(minimum=1)
+        schema['mmap_size'] = config.Integer(minimum=0)
+        schema['page_size'] = config.Integer(
+            choices=[2 ** i for i in range(9, 17)])
+        schema['synchronous'] = config.String(
+            choices=['off', 'normal', 'full', 'extra'])
+        schema['temp_store'] = config.String(
+            choices=['default', 'file', 'memory'])
+        schema['fast_scan'] = config.Boolean()
+        schema['read_connections'] = config.Boolean()
+        schema['background_writer'] = config.Boolean()
+        schema['memory_index'] = config.Boolean()
+        schema['vacuum'] = config.Boolean()
         return schema
 
     def setup(self, registry):
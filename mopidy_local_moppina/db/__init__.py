@@ -1,323 +1,973 @@
-import logging
 import itertools
+import logging
+import operator
+import re
+from functools import reduce
 from hashlib import md5
 
-from .models import (db_proxy, Artist, Album, Track, ArtistFTS,
-                     AlbumFTS, TrackFTS)
+from peewee import JOIN, SQL, chunked, fn
 
-from peewee import fn, SQL
+from . import migrations, schema
+from .models import (Album, AlbumArtistLink, AlbumFTS, Artist, ArtistFTS,
+                     Track, TrackArtistLink, TrackFTS, db_proxy)
+from ..cache import LRUCache
+from ..utils import fingerprint, split_browse_uri
 
 
 logger = logging.getLogger(__name__)
 
 
+# Default SQLITE_MAX_VARIABLE_NUMBER for SQLite builds older than 3.32
+SQLITE_MAX_VARIABLES = 999
+
+# Share of the tracks changed by a session above which the query planner
+# statistics are refreshed on close, and rows sampled per index to do so
+# (the limit is ignored by SQLite builds older than 3.32)
+ANALYZE_THRESHOLD = 0.1
+ANALYSIS_LIMIT = 1000
+
+
+# Mopidy search fields -> FTS columns of each FTS model
+FTS_COLUMNS = {
+    ArtistFTS: {
+        'artist': 'name',
+        'albumartist': 'name',
+        'composer': 'name',
+        'performer': 'name'
+    },
+    AlbumFTS: {
+        'album': 'name',
+        'artist': 'artist',
+        'albumartist': 'artist'
+    },
+    TrackFTS: dict((f, f) for f in (
+        'track_name', 'album', 'artist', 'composer', 'performer',
+        'albumartist', 'genre', 'track_no', 'date', 'comment'
+    ))
+}
+
+_WORDS_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _chunk_size(model):
+    return max(1, SQLITE_MAX_VARIABLES // len(model._meta.fields))
+
+
+def _digest(row, *extra):
+    return md5(repr((sorted(row.items()),) + extra)).hexdigest()
+
+
+def _match_expression(ftsmodel, query, prefix=False):
+    """
+    Build a MATCH expression requiring every term (or, with ``prefix``, a
+    word starting with every term) of every query value, restricted to the
+    FTS column mapped to the query field; returns None if the query has a
+    field that the model can't match. The ``uri`` field is left to
+    ``_uri_conditions``.
+    """
+    columns = FTS_COLUMNS[ftsmodel]
+    terms = []
+    for field, values in query.iteritems():
+        if field == 'uri':
+            continue
+        elif field == 'any':
+            column = None
+        elif field in columns:
+            column = columns[field]
+        else:
+            return None
+        for value in values:
+            for word in _WORDS_RE.findall('%s' % value):
+                term = '"%s"*' % word if prefix else '"%s"' % word
+                terms.append('%s:%s' % (column, term) if column else term)
+    return ' '.join(terms)
+
+
+def _uri_conditions(model, query):
+    # Uris are not tokenized, a value matches the uris containing it
+    return [model.uri.contains(value) for value in query.get('uri', ())]
+
+
+def _nocase(field, value):
+    return field.collate('NOCASE') == value
+
+
+def _artist_ids(value):
+    return Artist.select(Artist.id).where(_nocase(Artist.name, value))
+
+
+def _album_ids(condition):
+    return Album.select(Album.id).where(condition)
+
+
+def _track_no(value):
+    try:
+        return Track.track_no == int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _artist_name(value):
+    return _nocase(Artist.name, value)
+
+
+def _role(role):
+    return TrackArtistLink.role == TrackArtistLink.ROLES.index(role)
+
+
+def _track_artist(role):
+    # Tracks with the artist either first or linked, as a UNION of ids
+    # that can use the indexes of both tables
+    field = getattr(Track, role)
+
+    def condition(v):
+        linked = (TrackArtistLink.select(TrackArtistLink.track)
+                  .where(_role(role) &
+                         (TrackArtistLink.artist << _artist_ids(v))))
+        return Track.id << (
+            Track.select(Track.id).where(field << _artist_ids(v)) | linked)
+    return condition
+
+
+def _album_artist_ids(artist_ids):
+    linked = (AlbumArtistLink.select(AlbumArtistLink.album)
+              .where(AlbumArtistLink.artist << artist_ids))
+    return Album.select(Album.id).where(Album.artists << artist_ids) | linked
+
+
+def _album_artist(value):
+    return Album.id << _album_artist_ids(_artist_ids(value))
+
+
+# Mopidy search fields -> conditions on the (indexed) columns of a model;
+# names are compared case-insensitively through COLLATE NOCASE indexes.
+EXACT_FIELDS = {
+    Artist: {
+        'uri': lambda v: Artist.uri == v,
+        'artist': _artist_name,
+        'albumartist': _artist_name,
+        'composer': _artist_name,
+        'performer': _artist_name
+    },
+    Album: {
+        'uri': lambda v: Album.uri == v,
+        'album': lambda v: _nocase(Album.name, v),
+        'artist': _album_artist,
+        'albumartist': _album_artist,
+        'date': lambda v: Album.date == v
+    },
+    Track: {
+        'uri': lambda v: Track.uri == v,
+        'track_name': lambda v: _nocase(Track.name, v),
+        'album': lambda v: Track.album << _album_ids(_nocase(Album.name, v)),
+        'artist': _track_artist('artists'),
+        'albumartist': lambda v: Track.album << _album_artist_ids(
+            _artist_ids(v)),
+        'composer': _track_artist('composers'),
+        'performer': _track_artist('performers'),
+        'genre': lambda v: _nocase(Track.genre, v),
+        'date': lambda v: Track.date == v,
+        'track_no': _track_no,
+        'comment': lambda v: _nocase(Track.comment, v)
+    }
+}
+
+
+def _exact_conditions(model, query):
+    """
+    Build the condition matching every value of every query field
+    exactly, 'any' matching one of the model fields; returns None if the
+    query has a field that the model can't match.
+    """
+    fields = EXACT_FIELDS[model]
+    any_fields = set(f for name, f in fields.items() if name != 'uri')
+    q = SQL('1 = 1')
+    for field, values in query.iteritems():
+        if field != 'any' and field not in fields:
+            return None
+        for value in values:
+            if field != 'any':
+                condition = fields[field](value)
+                if condition is None:
+                    return None
+                q &= condition
+                continue
+            # An OR across columns can't use their indexes, a UNION can
+            ids = [model.select(model.id).where(c) for c in
+                   (f(value) for f in any_fields) if c is not None]
+            q &= model.id << reduce(operator.or_, ids)
+    return q
+
+
+def _distinct_artists(role):
+    field = getattr(Track, role)
+
+    def distinct(tracks):
+        links = (TrackArtistLink.select(TrackArtistLink.artist)
+                 .where(_role(role) &
+                        (TrackArtistLink.track << tracks.select(Track.id))))
+        return (Artist.select(Artist.name)
+                .where(Artist.id << (tracks.select(field) | links)))
+    return distinct
+
+
+def _distinct_album_artists(tracks):
+    albums = tracks.select(Track.album)
+    links = (AlbumArtistLink.select(AlbumArtistLink.artist)
+             .where(AlbumArtistLink.album << albums))
+    return (Artist.select(Artist.name)
+            .where(Artist.id << (Album.select(Album.artists)
+                                 .where(Album.id << albums) | links)))
+
+
+# get_distinct fields -> query of the field values, given the tracks query
+DISTINCT_FIELDS = {
+    'artist': _distinct_artists('artists'),
+    'composer': _distinct_artists('composers'),
+    'performer': _distinct_artists('performers'),
+    'albumartist': _distinct_album_artists,
+    'album': lambda tracks: Album.select(Album.name).where(
+        Album.id << tracks.select(Track.album)),
+    'genre': lambda tracks: tracks.select(Track.genre),
+    'date': lambda tracks: tracks.select(Track.date)
+}
+
+
+# browse kinds -> model and sort key, matching the schema indexes
+BROWSE_KINDS = {
+    'artists': (Artist,
+                fn.COALESCE(Artist.sortname, Artist.name).collate('NOCASE')),
+    'albums': (Album, Album.name.collate('NOCASE')),
+    'tracks': (Track, Track.name.collate('NOCASE'))
+}
+
+
+def _initial(key, initial):
+    # NOCASE compares letters as lowercase: the letters are followed by
+    # '{', not by '['
+    if initial == '#':
+        return (key < 'A') | (key >= '{')
+    if len(initial) != 1 or not 'A' <= initial.upper() <= 'Z':
+        raise ValueError('Invalid initial %r' % initial)
+    initial = initial.lower()
+    return (key >= initial) & (key < chr(ord(initial) + 1))
+
+
+def _artist_scope(model, condition):
+    artists = Artist.select(Artist.id).where(condition)
+    albums = Album.select(Album.id).where(Album.artists << artists)
+    return {
+        Artist: condition,
+        Album: Album.id << albums,
+        Track: (Track.album << albums) | (Track.artists << artists)
+    }[model]
+
+
+def _album_scope(model, condition):
+    return {
+        Artist: Artist.id << Album.select(Album.artists).where(condition),
+        Album: condition,
+        Track: Track.album << Album.select(Album.id).where(condition)
+    }[model]
+
+
+def _track_scope(model, condition):
+    return {
+        Artist: Artist.id << Track.select(Track.artists).where(condition),
+        Album: Album.id << Track.select(Track.album).where(condition),
+        Track: condition
+    }[model]
+
+
+# browse kinds -> scope of the search below a listing, given the
+# condition on its rows
+BROWSE_SCOPES = {
+    'artists': _artist_scope,
+    'albums': _album_scope,
+    'tracks': _track_scope
+}
+
+
+def _ordered(artists):
+    # Mopidy keeps the artists in sets, give them a stable order
+    return sorted(artists or (), key=lambda a: (a.name, a.uri))
+
+
+def _first(artists):
+    return next(iter(_ordered(artists)), None)
+
+
+# Additional artists of the selected tracks and albums, as
+# 'role:position:artist id' values
+_TRACK_LINKS = (
+    TrackArtistLink
+    .select(fn.group_concat(fn.printf('%d:%d:%d', TrackArtistLink.role,
+                                      TrackArtistLink.position,
+                                      TrackArtistLink.artist)))
+    .where(TrackArtistLink.track == Track.id))
+
+_ALBUM_LINKS = (
+    AlbumArtistLink
+    .select(fn.group_concat(fn.printf('0:%d:%d', AlbumArtistLink.position,
+                                      AlbumArtistLink.artist)))
+    .where(AlbumArtistLink.album == Album.id))
+
+
+def _parse_links(value, roles):
+    """
+    Parse the group_concat of links into a role -> artist ids mapping.
+    """
+    links = {}
+    for role, _, artist in sorted(tuple(int(v) for v in link.split(':'))
+                                  for link in value.split(',')):
+        links.setdefault(roles[role], []).append(artist)
+    return links
+
+
 class Database():
-    def __init__(self, db):
+    def __init__(self, db, cache_size=10000, reader=None, browse_limit=500):
         self._db = db
+        self._browse_limit = browse_limit
+        # Reads go through their own connections, if given, so that they
+        # are not queued behind the transactions of the writer
+        self._reader = reader or db
+        # uri -> (id, content digest) of the rows written by this process
+        self._artist_cache = LRUCache(cache_size)
+        self._album_cache = LRUCache(cache_size)
         self.connect()
 
+    def _invalidate_caches(self):
+        self._artist_cache.clear()
+        self._album_cache.clear()
+
+    def cache_stats(self):
+        return {
+            'artists': self._artist_cache.stats(),
+            'albums': self._album_cache.stats()
+        }
+
 
     def connect(self):
         db_proxy.initialize(self._db)
-        db_proxy.create_tables([
-            Artist, 
-            Album, 
-            Track,
-            ArtistFTS,
-            AlbumFTS,
-            TrackFTS
-        ])
-
-    def close(self):
-        self._db.execute_sql('ANALYZE')
+        migrations.migrate(self._db)
+
+    def close(self, changes=0):
+        """
+        Close the connections. When ``changes`` tracks were written or
+        deleted, compared to the library size, run an approximate
+        ``ANALYZE``; otherwise only ``PRAGMA optimize``, which analyzes
+        the tables that need it, if any.
+        """
+        if changes and changes >= ANALYZE_THRESHOLD * self.tracks_count():
+            logger.info('local-moppina: analyze database')
+            self._db.execute_sql('PRAGMA analysis_limit = %d' %
+                                 ANALYSIS_LIMIT)
+            self._db.execute_sql('ANALYZE')
+        else:
+            self._db.execute_sql('PRAGMA optimize')
         self._db.close()
+        if self._reader is not self._db:
+            self._reader.close()
 
     def clear(self):
         logger.info('local-moppina: clear database')
+        self._invalidate_caches()
         with self._db.atomic():
-            self._db.execute_sql('DELETE FROM trackfts')
+            # Empty the index at once instead of row by row from triggers
+            schema.drop_fts_triggers(self._db)
+            schema.clear_fts(self._db)
+            self._db.execute_sql('DELETE FROM track_artist')
+            self._db.execute_sql('DELETE FROM album_artist')
             self._db.execute_sql('DELETE FROM track')
-            self._db.execute_sql('DELETE FROM albumfts')
             self._db.execute_sql('DELETE FROM album')
-            self._db.execute_sql('DELETE FROM artistfts')
             self._db.execute_sql('DELETE FROM artist')
+            schema.create_fts_triggers(self._db)
         self._db.execute_sql('VACUUM')
 
-        
-
-    def _upsert_artists_fts(self, artist):
-        fts_artist, created = ArtistFTS.get_or_create(
-            rowid=artist.id,
-            defaults=dict(
-                uri=artist.uri,
-                name=artist.name
-            )
-        )
-        if not created:
-            fts_artist.uri = artist.uri
-            fts_artist.name = artist.name
-            fts_artist.save()
-
+    def _ids_by_uri(self, model, uris):
+        ids = {}
+        for batch in chunked(uris, SQLITE_MAX_VARIABLES):
+            qs = (model.select(model.id, model.uri)
+                  .where(model.uri << batch)
+                  .tuples())
+            ids.update((uri, pk) for pk, uri in qs)
+        return ids
+
+    def _bulk_upsert(self, model, rows, preserve):
+        for batch in chunked(rows, _chunk_size(model)):
+            (model.insert_many(batch)
+                .on_conflict(conflict_target=[model.uri], preserve=preserve)
+                .execute())
+
+    def _cached_upsert(self, model, cache, rows, preserve, links=None):
+        """
+        Upsert the rows whose content, or ``links``, changed since they
+        were last written through ``cache``; returns the uri -> id mapping
+        of all the rows and the list of the changed uris.
+        """
+        ids = {}
+        changed = []
+        for row in rows:
+            digest = _digest(row, (links or {}).get(row['uri']))
+            cached = cache.get(row['uri'])
+            if cached and cached[1] == digest:
+                ids[row['uri']] = cached[0]
+            else:
+                changed.append((row, digest))
+
+        if not changed:
+            return ids, []
+
+        self._bulk_upsert(model, [row for row, _ in changed], preserve)
+        changed_ids = self._ids_by_uri(model,
+                                       [row['uri'] for row, _ in changed])
+        for row, digest in changed:
+            cache.put(row['uri'], (changed_ids[row['uri']], digest))
+        ids.update(changed_ids)
+        return ids, [row['uri'] for row, _ in changed]
+
+    def _replace_links(self, link_model, owner, ids, links):
+        """
+        Replace the links of the ``ids`` owner rows with ``links``,
+        a list of link rows.
+        """
+        field = getattr(link_model, owner)
+        for batch in chunked(ids, SQLITE_MAX_VARIABLES):
+            link_model.delete().where(field << batch).execute()
+        for batch in chunked(links, _chunk_size(link_model)):
+            link_model.insert_many(batch).execute()
 
     def _upsert_artists(self, artists):
-        if not artists:
-            return
-        artist = next(iter(artists))
-
-        db_artist, created = Artist.get_or_create(
+        rows = [dict(
             uri=artist.uri,
-            defaults=dict(
-                name=artist.name,
-                sortname=artist.sortname,
-                musicbrainz_id=artist.musicbrainz_id
-            )
-        )
-        if not created:
-            db_artist.name = artist.name
-            db_artist.sortname = artist.sortname
-            db_artist.musicbrainz_id = artist.musicbrainz_id
-            db_artist.save()
-
-        self._upsert_artists_fts(db_artist)
-        
-        return db_artist
-
-
-    def _upsert_album_fts(self, album):
-        fts_album, created = AlbumFTS.get_or_create(
-            rowid=album.id,
-            defaults=dict(
-                uri=album.uri,
-                name=album.name,
-                artist=album.artists.name
-            )
-        )
-        if not created:
-            fts_album.uri = album.uri
-            fts_album.name = album.name
-            fts_album.artist = album.artists.name
-            fts_album.save()
-
-    def _upsert_album(self, album):
-        artists = self._upsert_artists(album.artists)
-        logger.debug('local-moppina upsert album, artist: %s', artists)
-        
-        db_album, created = Album.get_or_create(
+            name=artist.name,
+            sortname=artist.sortname,
+            musicbrainz_id=artist.musicbrainz_id
+        ) for artist in artists.values()]
+        ids, _ = self._cached_upsert(Artist, self._artist_cache, rows, [
+            Artist.name,
+            Artist.sortname,
+            Artist.musicbrainz_id
+        ])
+        return ids
+
+    def _upsert_albums(self, albums, artist_ids):
+        links = dict((album.uri, tuple(artist_ids[a.uri] for a in
+                                       _ordered(album.artists)[1:]))
+                     for album in albums.values())
+        rows = [dict(
             uri=album.uri,
-            defaults=dict(
-                name=album.name,
-                artists=artists,
-                num_tracks=album.num_tracks,
-                num_discs=album.num_discs,
-                date=album.date,
-                musicbrainz_id=album.musicbrainz_id,
-                images=' '.join(album.images) if album.images else None
-            )
-        )
+            name=album.name,
+            artists=artist_ids[_first(album.artists).uri],
+            num_tracks=album.num_tracks,
+            num_discs=album.num_discs,
+            date=album.date,
+            musicbrainz_id=album.musicbrainz_id,
+            images=' '.join(album.images) if album.images else None
+        ) for album in albums.values()]
+        ids, changed = self._cached_upsert(Album, self._album_cache, rows, [
+            Album.name,
+            Album.artists,
+            Album.num_tracks,
+            Album.num_discs,
+            Album.date,
+            Album.musicbrainz_id,
+            Album.images
+        ], links)
+        changed_ids = [ids[uri] for uri in changed]
+        self._replace_links(AlbumArtistLink, 'album', changed_ids, [
+            dict(album=ids[uri], artist=artist, position=position)
+            for uri in changed
+            for position, artist in enumerate(links[uri], 1)
+        ])
+        return ids
+
+    def _stored_fingerprints(self, uris):
+        stored = {}
+        for batch in chunked(uris, SQLITE_MAX_VARIABLES):
+            qs = (Track.select(Track.uri, Track.fingerprint,
+                               Track.last_modified)
+                  .where(Track.uri << batch)
+                  .tuples())
+            stored.update((uri, (fp, mtime)) for uri, fp, mtime in qs)
+        return stored
+
+    def _upsert_tracks(self, tracks, album_ids, artist_ids):
+        def artist_id(artists):
+            artist = _first(artists)
+            return artist_ids[artist.uri] if artist else None
+
+        rows = [dict(
+            uri=track.uri,
+            name=track.name,
+            album=album_ids[track.album.uri],
+            artists=artist_id(track.artists),
+            composers=artist_id(track.composers),
+            performers=artist_id(track.performers),
+            genre=track.genre,
+            track_no=track.track_no,
+            disc_no=track.disc_no,
+            date=track.date,
+            length=track.length,
+            bitrate=track.bitrate,
+            comment=track.comment,
+            musicbrainz_id=track.musicbrainz_id,
+            last_modified=track.last_modified,
+            fingerprint=fingerprint(track)
+        ) for track in tracks]
+        self._bulk_upsert(Track, rows, [
+            f for f in Track._meta.sorted_fields
+            if f.name not in ('id', 'uri')
+        ])
 
-        if not created:
-            db_album.name = album.name
-            db_album.artists = artists
-            db_album.num_tracks = album.num_tracks
-            db_album.num_discs = album.num_discs
-            db_album.date = db_album.date
-            db_album.musicbrainz_id = album.musicbrainz_id
-            db_album.images = album.images
-            db_album.save()
-        
-        self._upsert_album_fts(db_album)
-
-        return db_album
-
-
-    def _upsert_track_fts(self, track):
-        fts_track, created = TrackFTS.get_or_create(
-            rowid=track.id,
-            defaults=dict(
-                uri=track.uri,
-                track_name=track.name,
-                album=track.album.name,
-                artist=track.artists.name if track.artists else None,
-                composer=track.composers.name if track.composers else None,
-                performer=track.performers.name if track.performers else None,
-                albumartist=track.album.artists.name if track.album.artists else None,
-                genre=track.genre,
-                track_no=track.track_no,
-                date=track.date,
-                comment=track.comment
-            )
-        )
-        if not created:
-            fts_track.uri = track.uri
-            fts_track.track_name = track.name
-            fts_track.album = track.album.name
-            fts_track.artist = track.artists.name if track.artists else None
-            fts_track.composer = track.composers.name if track.composers else None
-            fts_track.performer = track.performers.name if track.performers else None
-            fts_track.albumartist = track.album.artists.name if track.album.artists else None
-            fts_track.genre = track.genre
-            fts_track.track_no = track.track_no
-            fts_track.date = track.date
-            fts_track.comment = track.comment
-            fts_track.save()       
+        links = dict((track.uri, [
+            (role, artist_ids[a.uri])
+            for role in TrackArtistLink.ROLES
+            for a in _ordered(getattr(track, role))[1:]
+        ]) for track in tracks)
+        track_ids = self._ids_by_uri(Track, list(links))
+        self._replace_links(TrackArtistLink, 'track', track_ids.values(), [
+            dict(track=track_ids[uri],
+                 artist=artist,
+                 role=TrackArtistLink.ROLES.index(role),
+                 position=position)
+            for uri, artists in links.items()
+            for role, group in itertools.groupby(artists,
+                                                 operator.itemgetter(0))
+            for position, (_, artist) in enumerate(group, 1)
+        ])
 
+    def upsert_tracks(self, tracks):
+        """
+        Insert or update a batch of (already checked) mopidy tracks,
+        together with their albums and artists, using one multi-row
+        ``INSERT ... ON CONFLICT DO UPDATE`` per table and chunk; the
+        full-text index is kept in sync by triggers.
+        """
+        tracks = list(tracks)
+        if not tracks:
+            return 0
+        logger.debug('local-moppina: upsert %d tracks', len(tracks))
+
+        # Unchanged tracks are skipped, at most their mtime is refreshed
+        stored = self._stored_fingerprints([t.uri for t in tracks])
+        changed = []
+        touched = []
+        for track in tracks:
+            fp, mtime = stored.get(track.uri, (None, None))
+            if fp != fingerprint(track):
+                changed.append(track)
+            elif mtime != track.last_modified:
+                touched.append(track)
+        logger.debug('local-moppina: %d changed, %d touched tracks',
+                     len(changed), len(touched))
+
+        if touched:
+            with self._db.atomic():
+                for track in touched:
+                    (Track.update(last_modified=track.last_modified)
+                        .where(Track.uri == track.uri)
+                        .execute())
+
+        tracks = changed
+        if not tracks:
+            return 0
+
+        artists = {}
+        albums = {}
+        for track in tracks:
+            albums[track.album.uri] = track.album
+            for group in (track.album.artists, track.artists,
+                          track.composers, track.performers):
+                for artist in group or ():
+                    artists[artist.uri] = artist
+
+        try:
+            with self._db.atomic():
+                artist_ids = self._upsert_artists(artists)
+                album_ids = self._upsert_albums(albums, artist_ids)
+                self._upsert_tracks(tracks, album_ids, artist_ids)
+        except Exception:
+            # The cached ids may refer to rows that were rolled back
+            self._invalidate_caches()
+            raise
+
+        return len(tracks)
 
     def upsert_track(self, track):
         logger.debug('local-moppina: process track %s', track)
-
-        with self._db.atomic():
-            album = None
-            artists = None
-            composers = None
-            performers = None
-            if track.album:
-                album = self._upsert_album(track.album)
-            if track.artists:
-                artists = self._upsert_artists(track.artists)
-            if track.composers:
-                composers = self._upsert_artists(track.composers)
-            if track.performers:
-                performers = self._upsert_artists(track.performers)
-
-            db_track, created = Track.get_or_create(
-                uri=track.uri,
-                defaults=dict(
-                    name=track.name,
-                    album=album,
-                    artists=artists,
-                    composers=composers,
-                    performers=performers,
-                    genre=track.genre,
-                    track_no=track.track_no,
-                    disc_no=track.disc_no,
-                    date=track.date,
-                    length=track.length,
-                    bitrate=track.bitrate,
-                    comment=track.comment,
-                    musicbrainz_id=track.musicbrainz_id,
-                    last_modified=track.last_modified
-                )
-            )
-            if not created:
-                    db_track.name = track.name
-                    db_track.album = album
-                    db_track.artists = artists
-                    db_track.composers = composers
-                    db_track.performers = performers
-                    db_track.genre = track.genre
-                    db_track.track_no = track.track_no
-                    db_track.disc_no = track.disc_no
-                    db_track.date = track.date
-                    db_track.length = track.length
-                    db_track.bitrate = track.bitrate
-                    db_track.comment = track.comment
-                    db_track.musicbrainz_id = track.musicbrainz_id
-                    db_track.last_modified = track.last_modified
-        
-            self._upsert_track_fts(db_track)
-
-
-    def artists(self):
-        return Artist.select().order_by(Artist.name)
-
-    def albums(self):
-        return Album.select().order_by(Album.artists, Album.name)
-
-    def tracks(self):
-        return Track.select()
+        return self.upsert_tracks([track])
+
+    def browse(self, kind, initial=None, year=None, genre=None):
+        """
+        Select uri and name of the artists, albums or tracks ordered by
+        their sort key, optionally restricted to the ones whose sort key
+        starts with ``initial`` ('#' for anything but a letter), to the
+        albums with tracks of a ``year`` or to the tracks of a ``genre``.
+        """
+        model, key = BROWSE_KINDS[kind]
+        qs = model.select(model.uri, model.name).order_by(key)
+        if initial:
+            qs = qs.where(_initial(key, initial))
+        if year and model is Album:
+            year = int(year)
+            albums = (Track.select(Track.album)
+                      .where((Track.date >= '%04d' % year) &
+                             (Track.date < '%04d' % (year + 1))))
+            qs = qs.where(Album.id << albums)
+        if genre and model is Track:
+            qs = qs.where(_nocase(Track.genre, genre))
+        return qs.bind(self._reader)
+
+    def years(self):
+        year = fn.SUBSTR(Track.date, 1, 4)
+        qs = (Track.select(year)
+              .where(Track.date.is_null(False))
+              .distinct()
+              .order_by(year)
+              .tuples()
+              .bind(self._reader))
+        return [y for y, in qs]
+
+    def genres(self):
+        qs = (Track.select(Track.genre)
+              .where(Track.genre.is_null(False))
+              .distinct()
+              .order_by(Track.genre)
+              .tuples()
+              .bind(self._reader))
+        return [g for g, in qs]
+
+    def _select_tracks(self):
+        """
+        Select tracks joined with their album and artists, so that the
+        relations accessed by ``to_track`` don't need further queries.
+        """
+        AlbumArtist = Artist.alias()
+        TrackArtist = Artist.alias()
+        Composer = Artist.alias()
+        Performer = Artist.alias()
+        return (Track.select(Track, Album, AlbumArtist, TrackArtist,
+                             Composer, Performer,
+                             _TRACK_LINKS.alias('track_links'),
+                             _ALBUM_LINKS.alias('album_links'))
+                .join(Album, on=Track.album)
+                .join(AlbumArtist, on=Album.artists)
+                .switch(Track)
+                .join(TrackArtist, JOIN.LEFT_OUTER, on=Track.artists)
+                .switch(Track)
+                .join(Composer, JOIN.LEFT_OUTER, on=Track.composers)
+                .switch(Track)
+                .join(Performer, JOIN.LEFT_OUTER, on=Track.performers)
+                .bind(self._reader))
+
+    def _select_albums(self):
+        return (Album.select(Album, Artist,
+                             _ALBUM_LINKS.alias('album_links'))
+                .join(Artist, on=Album.artists)
+                .bind(self._reader))
+
+    def _select(self, model):
+        if model is Track:
+            return self._select_tracks()
+        if model is Album:
+            return self._select_albums()
+        return model.select().bind(self._reader)
+
+    def _linked(self, rows):
+        """
+        Attach the additional artists of the selected tracks and albums to
+        the rows, as ``linked`` role -> artists mappings. The artists are
+        read with one query per chunk of rows, only if they have any.
+        """
+        for batch in chunked(rows, SQLITE_MAX_VARIABLES):
+            pending = []
+            for row in batch:
+                album = row.album if isinstance(row, Track) else row
+                for target, links, roles in (
+                        (row, getattr(row, 'track_links', None),
+                         TrackArtistLink.ROLES),
+                        (album, getattr(row, 'album_links', None),
+                         ('artists',))):
+                    if links:
+                        pending.append((target, _parse_links(links, roles)))
+
+            ids = set(i for _, links in pending
+                      for group in links.values() for i in group)
+            artists = {}
+            for ids_batch in chunked(ids, SQLITE_MAX_VARIABLES):
+                qs = (Artist.select()
+                      .where(Artist.id << ids_batch)
+                      .bind(self._reader))
+                artists.update((a.id, a) for a in qs)
+            for target, links in pending:
+                target.linked = dict(
+                    (role, [artists[i] for i in group])
+                    for role, group in links.items())
+            for row in batch:
+                yield row
+
+    def iter_tracks(self):
+        """
+        Stream all the tracks, with their relations, from a single query
+        without caching the rows.
+        """
+        return self._linked(self._select_tracks().iterator())
+
+    def track_mtimes(self):
+        """
+        Iterate over ``(uri, last_modified)`` of all the stored tracks.
+        """
+        return (Track.select(Track.uri, Track.last_modified)
+                .tuples()
+                .bind(self._reader)
+                .iterator())
+
+    def tracks_slice(self, limit, offset, uris=None):
+        qs = self._select_tracks()
+        scope = self._scope(Track, uris)
+        if scope is not None:
+            qs = qs.where(scope)
+        return list(self._linked(qs.limit(limit).offset(offset)))
 
     def tracks_count(self):
-        return Track.select().count()
+        return Track.select().bind(self._reader).count()
 
 
     def albums_by_artist(self, uri):
         logger.debug('local-moppina: get albums for artist %s', uri)
-        return (Album.select()
-            .join(Artist)
+        return (self._select_albums()
             .where(Artist.uri == uri)
             .order_by(Album.name))
 
+    def _tracks_of_album(self, uri):
+        return (self._select_tracks()
+                .where(Album.uri == uri)
+                .order_by(Track.disc_no, Track.track_no))
 
     def tracks_by_album(self, uri):
-        return (Track.select()
-            .join(Album)
-            .where(Album.uri == uri)
-            .order_by(Track.track_no))
+        return list(self._linked(self._tracks_of_album(uri)))
 
     def tracks_by_artist(self, uri):
-        return (Track.select()
-            .join(Album)
-            .join(Artist)
-            .where(Artist.uri == uri))
+        artist = Artist.select(Artist.id).where(Artist.uri == uri)
+        return list(self._linked(
+            self._select_tracks().where(Album.artists == artist)))
     
     def track_by_uri(self, uri):
-        return (Track.select()
-            .where(Track.uri == uri))
-
-    def delete_track(self, uri):
-        Track.delete().where(Track.uri == uri)
+        return list(self._linked(
+            self._select_tracks().where(Track.uri == uri)))
+
+    def tracks_by_uris(self, kind, uris):
+        """
+        Iterate over the tracks of many track, album or artist uris, with
+        one query per chunk of uris over the unique uri indexes.
+        """
+        for batch in chunked(uris, SQLITE_MAX_VARIABLES):
+            qs = self._select_tracks()
+            if kind == 'track':
+                qs = qs.where(Track.uri << batch)
+            elif kind == 'album':
+                albums = Album.select(Album.id).where(Album.uri << batch)
+                qs = (qs.where(Track.album << albums)
+                      .order_by(Album.id, Track.disc_no, Track.track_no))
+            elif kind == 'artist':
+                artists = Artist.select(Artist.id).where(Artist.uri << batch)
+                qs = qs.where(Album.artists << artists)
+            else:
+                raise ValueError('Invalid lookup kind %r' % kind)
+            for row in self._linked(qs.iterator()):
+                yield row
+
+    def delete_tracks(self, uris):
+        """
+        Delete the tracks of the given uris, in chunks, and return their
+        number. Their full-text entries are deleted by triggers and their
+        artist links by the foreign keys.
+        """
+        count = 0
+        with self._db.atomic():
+            for batch in chunked(uris, SQLITE_MAX_VARIABLES):
+                count += Track.delete().where(Track.uri << batch).execute()
+        logger.debug('local-moppina: deleted %d tracks', count)
+        return count
+
+    def delete_orphans(self):
+        """
+        Delete the albums left without tracks, then the artists no longer
+        referenced by any track or album, with one statement per table.
+        Returns the number of deleted albums and artists.
+        """
+        referenced = reduce(operator.or_, [
+            Track.select(field).where(field.is_null(False))
+            for field in (Track.artists, Track.composers, Track.performers)
+        ] + [
+            Album.select(Album.artists),
+            TrackArtistLink.select(TrackArtistLink.artist),
+            AlbumArtistLink.select(AlbumArtistLink.artist)
+        ])
+        with self._db.atomic():
+            albums = (Album.delete()
+                      .where(Album.id.not_in(Track.select(Track.album)))
+                      .execute())
+            artists = (Artist.delete()
+                       .where(Artist.id.not_in(referenced))
+                       .execute())
+        if albums or artists:
+            logger.info('local-moppina: deleted %d orphaned albums and %d '
+                        'orphaned artists', albums, artists)
+            self._invalidate_caches()
+        return albums, artists
+
+    def vacuum(self):
+        """
+        Release the free pages of the database file. The first call
+        switches the database to incremental auto-vacuum, which takes a
+        full ``VACUUM``; the next ones are incremental.
+        """
+        mode, = self._db.execute_sql('PRAGMA auto_vacuum').fetchone()
+        if mode != 2:
+            logger.info('local-moppina: enable incremental vacuum')
+            self._db.execute_sql('PRAGMA auto_vacuum = incremental')
+            self._db.execute_sql('VACUUM')
+        else:
+            # Pages are released while the statement is stepped through
+            self._db.execute_sql('PRAGMA incremental_vacuum').fetchall()
 
     def get_distinct(self, field, query):
-        model_field = getattr(TrackFTS, field, None)
-        if not model_field:
+        """
+        Distinct values of ``field`` among the tracks matching the exact
+        ``query``, read through the foreign key and column indexes.
+        """
+        if field not in DISTINCT_FIELDS:
+            return set()
+        q = _exact_conditions(Track, query)
+        if q is None:
             return set()
 
-        q = SQL('1 = 1')
-
-        for f, values in query.iteritems():
-            for value in values:
-                q &= getattr(TrackFTS, f) == value
-
-        
-        qs = TrackFTS.select(fn.Distinct(model_field)).where(q)
-        results = qs.scalar(as_tuple=True)
-        return set(results) if results else set()
-
-    def _search(self, model, query, limit, offset):
-        q = SQL('1 = 1')
-        for field, values in query.iteritems():
-            if field == 'any':
-                or_cond = SQL('1 = 0')
-                for field_name in model._meta.fields.keys():
-                    if field_name == 'id':
-                        continue
-                        for value in values:
-                            or_cond |= getattr(model, field_name) == value
-                q &= or_cond
-                continue
-                
-            if hasattr(model, field):
-                for value in values:
-                    q &= getattr(model, field) == value
-        
-        return model.select().where(q).limit(limit).offset(offset)        
-
-
-    def _fts_search(self, model, ftsmodel, query, limit, offset):
-        logger.debug('Create fts search for model %s', model)
-        q = ftsmodel.match('')
-        for field_values in query.values():
-            for val in field_values:
-                q |= ftsmodel.match(val)
-
-        ids = [r.rowid for r in (ftsmodel.select(ftsmodel.rowid).where(q)
-            .order_by(ftsmodel.bm25())
-            .limit(limit)
-            .offset(offset))]
-
-        logger.debug('found this track ids: %s', ids)
-
-        return model.select().where(model.id << ids)
-
-
-    def search(self, query, limit, offset):
-        return (self._search(Artist, query, limit, offset),
-            self._search(Album, query, limit, offset),
-            self._search(Track, query, limit, offset))
-
-    def fts_search(self, query, limit, offset):
-        return (
-            self._fts_search(Artist, ArtistFTS, query, limit, offset),
-            self._fts_search(Album, AlbumFTS, query, limit, offset),
-            self._fts_search(Track, TrackFTS, query, limit, offset),
-        )
\ No newline at end of file
+        tracks = Track.select().where(q)
+        qs = (DISTINCT_FIELDS[field](tracks)
+              .distinct()
+              .tuples()
+              .bind(self._reader))
+        return set(value for value, in qs if value is not None)
+
+    def _paged_ids(self, qs, params):
+        """
+        Ids of the rows of the browse page, or span of pages, selected by
+        ``params``, ``qs`` being the ordered query of the whole listing.
+        """
+        limit = self._browse_limit
+        page = int(params['page'])
+        pages = int(params.get('pages', 1))
+        return (qs.select(qs.model.id)
+                .limit(pages * limit)
+                .offset(page * limit))
+
+    def _uri_scope(self, model, uri):
+        if uri == 'local:directory':
+            # The root directory: whole library
+            return None
+        path, params = split_browse_uri(uri)
+        base = 'local:' + path
+        paged = 'page' in params
+        if path.startswith('artist:'):
+            if paged:
+                return _album_scope(model, Album.id << self._paged_ids(
+                    self.albums_by_artist(base), params))
+            return _artist_scope(model, Artist.uri == base)
+        if path.startswith('album:'):
+            if paged and model is Track:
+                return Track.id << self._paged_ids(
+                    self._tracks_of_album(base), params)
+            return _album_scope(model, Album.uri == base)
+        if path.startswith('track:'):
+            return _track_scope(model, Track.uri == base)
+        if path.startswith('directory:'):
+            # Tracks below the directory, as a range over the uri index
+            start = 'local:track:%s/' % path[len('directory:'):]
+            stop = start[:-1] + '0'
+            return _track_scope(model, (Track.uri >= start) &
+                                       (Track.uri < stop))
+        if path in BROWSE_SCOPES:
+            filters = dict((k, v) for k, v in params.items()
+                           if k not in ('page', 'pages'))
+            if not paged and not filters:
+                # The artists, albums and tracks directories
+                return None
+            qs = self.browse(path, **filters)
+            if paged:
+                condition = qs.model.id << self._paged_ids(qs, params)
+            else:
+                condition = qs.model.id << qs.select(qs.model.id)
+            return BROWSE_SCOPES[path](model, condition)
+        if path in ('genres', 'years'):
+            # All the genres or years: whole library
+            return None
+        logger.warning('local-moppina: invalid search uri %s', uri)
+        return SQL('1 = 0')
+
+    def _scope(self, model, uris):
+        """
+        Condition restricting the ``model`` rows to the ones below the
+        given browse uris, None if they cover the whole library.
+        """
+        scope = None
+        for uri in uris or ():
+            condition = self._uri_scope(model, uri)
+            if condition is None:
+                return None
+            scope = condition if scope is None else scope | condition
+        return scope
+
+    def _search(self, model, query, limit, offset, scope):
+        q = _exact_conditions(model, query)
+        if q is None:
+            return []
+        if scope is not None:
+            q &= scope
+
+        qs = (self._select(model)
+              .where(q)
+              .limit(limit)
+              .offset(offset))
+        return list(self._linked(qs))
+
+    def _fts_search(self, model, ftsmodel, query, limit, offset, prefix,
+                    scope):
+        expression = _match_expression(ftsmodel, query, prefix)
+        conditions = _uri_conditions(model, query)
+        logger.debug('local-moppina: fts search %s for %s',
+                     ftsmodel.__name__, expression)
+        if expression is None or not (expression or conditions):
+            return []
+        if scope is not None:
+            conditions.append(scope)
+
+        qs = self._select(model).switch(model)
+        if expression:
+            qs = (qs.join(ftsmodel, on=(model.id == ftsmodel.rowid))
+                  .where(ftsmodel.match(expression))
+                  .order_by(ftsmodel.bm25()))
+        else:
+            qs = qs.order_by(model.uri)
+        if conditions:
+            qs = qs.where(reduce(operator.and_, conditions))
+        return list(self._linked(qs.limit(limit).offset(offset)))
+
+    def search(self, query, limit, offset, uris=None):
+        return tuple(
+            self._search(model, query, limit, offset,
+                         self._scope(model, uris))
+            for model in (Artist, Album, Track)
+        )
+
+    def fts_search(self, query, limit, offset, prefix=False, uris=None):
+        # Run the three searches on the same snapshot of the library
+        with self._reader.atomic():
+            return tuple(
+                self._fts_search(model, ftsmodel, query, limit, offset,
+                                 prefix, self._scope(model, uris))
+                for model, ftsmodel in ((Artist, ArtistFTS),
+                                        (Album, AlbumFTS),
+                                        (Track, TrackFTS))
+            )
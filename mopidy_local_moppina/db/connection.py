@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+
+logger = logging.getLogger(__name__)
+
+
+class MoppinaSqliteDatabase(SqliteExtDatabase):
+    """
+    SqliteExtDatabase that counts the executed SQL statements, so that
+    query regressions (e.g. N+1 patterns) can be measured and tested.
+
+    When ``slow_query_threshold`` (in seconds) is set, statements taking
+    longer than that to execute are logged with their query plan. Only
+    the execution up to the first row is timed, not the fetching of the
+    following rows.
+
+    Like any peewee database, every thread gets its own connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Statement counters and threshold, shared with the readers
+        self._shared = kwargs.pop('shared', None) or {
+            'queries': 0,
+            'slow_queries': 0,
+            'slow_query_threshold': kwargs.pop('slow_query_threshold', None)
+        }
+        super(MoppinaSqliteDatabase, self).__init__(*args, **kwargs)
+
+    @property
+    def query_count(self):
+        return self._shared['queries']
+
+    @property
+    def slow_query_count(self):
+        return self._shared['slow_queries']
+
+    @property
+    def slow_query_threshold(self):
+        return self._shared['slow_query_threshold']
+
+    @slow_query_threshold.setter
+    def slow_query_threshold(self, value):
+        self._shared['slow_query_threshold'] = value
+
+    def reader(self):
+        """
+        Return a database for read-only connections to the same file,
+        sharing the statement counters and settings of this one. In WAL
+        mode its connections read the last committed data without waiting
+        for the transactions of the writer.
+        """
+        pragmas = list(self._pragmas or ()) + [('query_only', 1)]
+        return MoppinaSqliteDatabase(
+            self.database, pragmas=pragmas, shared=self._shared,
+            **self.connect_params)
+
+    def execute_sql(self, sql, *args, **kwargs):
+        self._shared['queries'] += 1
+        threshold = self._shared['slow_query_threshold']
+        if not threshold:
+            return super(MoppinaSqliteDatabase, self).execute_sql(
+                sql, *args, **kwargs)
+        start = time.time()
+        cursor = super(MoppinaSqliteDatabase, self).execute_sql(
+            sql, *args, **kwargs)
+        elapsed = time.time() - start
+        if elapsed >= threshold:
+            self._shared['slow_queries'] += 1
+            params = args[0] if args else kwargs.get('params')
+            logger.warning('local-moppina: slow query (%.1fms): %s %r\n%s',
+                           elapsed * 1000, sql, params or (),
+                           self.query_plan(sql, params))
+        return cursor
+
+    def query_plan(self, sql, params=None):
+        """
+        Return the EXPLAIN QUERY PLAN output of a statement as text.
+        """
+        try:
+            cursor = self.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params or ())
+            return '\n'.join(' '.join('%s' % c for c in row)
+                             for row in cursor.fetchall())
+        except Exception as e:
+            return 'no query plan: %s' % e
@@ -0,0 +1,98 @@
+from __future__ import unicode_literals
+
+import logging
+
+from . import schema
+from .models import (Album, AlbumArtistLink, Artist, Track, TrackArtistLink,
+                     db_proxy)
+
+
+logger = logging.getLogger(__name__)
+
+
+MODELS = [Artist, Album, Track, TrackArtistLink, AlbumArtistLink]
+
+
+# Databases created before the schema was versioned are at version 0, in
+# the state left by whichever release wrote them: the migrations up to
+# version 4 check what they change instead of assuming a previous state.
+
+def _add_fingerprints(db):
+    columns = [c.name for c in db.get_columns('track')]
+    if 'fingerprint' not in columns:
+        # Only needed by the oldest databases, and slow to import
+        from playhouse.migrate import SqliteMigrator, migrate
+        logger.info('local-moppina: add track fingerprint column')
+        migrate(SqliteMigrator(db).add_column(
+            'track', 'fingerprint', Track.fingerprint))
+
+
+def _add_artist_links(db):
+    if db.table_exists(TrackArtistLink._meta.table_name):
+        return
+    db_proxy.create_tables([TrackArtistLink, AlbumArtistLink])
+    # Rewrite all the tracks on the next scan, storing the additional
+    # artists that older releases dropped: without a stored mtime the scan
+    # reads every file again
+    logger.info('local-moppina: reset track fingerprints and mtimes')
+    Track.update(fingerprint=None, last_modified=None).execute()
+
+
+def _create_indexes(db):
+    schema.create_indexes(db)
+
+
+def _create_fts(db):
+    rebuild = schema.drop_legacy_fts(db)
+    if schema.create_fts(db) or rebuild:
+        schema.rebuild_fts(db)
+
+
+# Migration i upgrades a database from version i to version i + 1
+MIGRATIONS = [
+    _add_fingerprints,
+    _add_artist_links,
+    _create_indexes,
+    _create_fts
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def create(db):
+    """
+    Create the tables, indexes and full-text index of a new database at
+    the current schema version.
+    """
+    logger.info('local-moppina: create database schema version %d',
+                SCHEMA_VERSION)
+    with db.atomic():
+        db_proxy.create_tables(MODELS)
+        schema.create_indexes(db)
+        schema.create_fts(db)
+        db.pragma('user_version', SCHEMA_VERSION)
+
+
+def migrate(db):
+    """
+    Bring the database to the current schema version, applying the
+    missing migrations in order, each one in its own transaction with
+    the version it results in. A current database only costs the read
+    of its ``user_version``.
+    """
+    version = db.pragma('user_version')
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        logger.warning('local-moppina: database schema version %d is newer '
+                       'than the supported version %d', version,
+                       SCHEMA_VERSION)
+        return
+    if version == 0 and not db.table_exists(Track._meta.table_name):
+        return create(db)
+    for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logger.info('local-moppina: migrate database schema to version %d',
+                    version)
+        with db.atomic():
+            migration(db)
+            db.pragma('user_version', version)
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 
 import logging
-from peewee import *
-from playhouse.sqlite_ext import RowIDField, SearchField, FTSModel
+
+from peewee import (CompositeKey, ForeignKeyField, IntegerField, Model, Proxy,
+                    TextField)
+
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 
 
 logger = logging.getLogger(__name__)
@@ -15,7 +18,8 @@ class BaseModel(Model):
     class Meta:
         database = db_proxy
 
-class BaseFTSModel(FTSModel):
+
+class BaseFTSModel(FTS5Model):
     class Meta:
         database = db_proxy    
 
@@ -40,10 +44,11 @@ class Album(BaseModel):
     name = TextField(
         index=True
     )
+    # Indexed together with the name, see schema.INDEXES
     artists = ForeignKeyField(
         Artist, 
         backref='albums', 
-        index=True
+        index=False
     )
     num_tracks = IntegerField(
         null=True
@@ -53,7 +58,7 @@ class Album(BaseModel):
     )
     date = TextField(
         null=True
-    ) # index ?
+    )
     musicbrainz_id = TextField(
         null=True
     )
@@ -69,10 +74,11 @@ class Track(BaseModel):
     name = TextField(
         index=True
     )
+    # Indexed together with the disc and track numbers
     album = ForeignKeyField(
         Album, 
         backref='tracks', 
-        index=True
+        index=False
     )
     artists = ForeignKeyField(
         Artist, 
@@ -98,13 +104,13 @@ class Track(BaseModel):
     )
     track_no = IntegerField(
         null=True
-    ) # index ?
+    )
     disc_no = IntegerField(
         null=True
     )
     date = TextField(
         null=True
-    ) # index ?
+    )
     length = IntegerField(
         null=True
     )
@@ -113,30 +119,94 @@ class Track(BaseModel):
     )
     comment = TextField(
         null=True
-    ) # index ?
+    )
     musicbrainz_id = TextField(
         null=True
     )
     last_modified = IntegerField(
         null=True
-    )  # index ?
+    )
+    fingerprint = TextField(
+        null=True
+    )
+
+
+class TrackArtistLink(BaseModel):
+    """
+    Additional artists, composers and performers of a track, beyond the
+    first one referenced by the track row itself.
+    """
+    ROLES = ('artists', 'composers', 'performers')
+
+    track = ForeignKeyField(
+        Track,
+        backref='artist_links',
+        on_delete='CASCADE'
+    )
+    artist = ForeignKeyField(
+        Artist,
+        backref='linked_tracks',
+        index=True
+    )
+    role = IntegerField()
+    position = IntegerField()
+
+    class Meta:
+        table_name = 'track_artist'
+        primary_key = CompositeKey('track', 'role', 'position')
+
+
+class AlbumArtistLink(BaseModel):
+    """
+    Additional artists of an album, beyond the first one referenced by
+    the album row itself.
+    """
+    album = ForeignKeyField(
+        Album,
+        backref='artist_links',
+        on_delete='CASCADE'
+    )
+    artist = ForeignKeyField(
+        Artist,
+        backref='linked_albums',
+        index=True
+    )
+    position = IntegerField()
+
+    class Meta:
+        table_name = 'album_artist'
+        primary_key = CompositeKey('album', 'position')
 
 
 class ArtistFTS(BaseFTSModel):
     rowid = RowIDField()
-    uri = SearchField()
+    uri = SearchField(unindexed=True)
     name = SearchField()
 
+    class Meta:
+        options = {
+            'content': "'artist'",
+            'content_rowid': "'id'",
+            'prefix': "'2 3'"
+        }
+
 class AlbumFTS(BaseFTSModel):
     rowid = RowIDField()
-    uri = SearchField()
+    uri = SearchField(unindexed=True)
     name = SearchField()
     artist = SearchField()
 
+    class Meta:
+        options = {
+            'content': "'albumfts_content'",
+            'content_rowid': "'id'",
+            'prefix': "'2 3'"
+        }
+
 
 class TrackFTS(BaseFTSModel):
     rowid = RowIDField()
-    uri = SearchField()
+    uri = SearchField(unindexed=True)
     track_name = SearchField()
     album = SearchField()
     artist = SearchField()
@@ -147,3 +217,10 @@ class TrackFTS(BaseFTSModel):
     track_no = SearchField()
     date = SearchField()
     comment = SearchField()
+
+    class Meta:
+        options = {
+            'content': "'trackfts_content'",
+            'content_rowid': "'id'",
+            'prefix': "'2 3'"
+        }
@@ -0,0 +1,291 @@
+from __future__ import unicode_literals
+
+import logging
+
+from playhouse.sqlite_ext import SearchField
+
+from .models import AlbumFTS, ArtistFTS, TrackArtistLink, TrackFTS
+
+
+logger = logging.getLogger(__name__)
+
+
+FTS_MODELS = [ArtistFTS, AlbumFTS, TrackFTS]
+
+
+def _names(alias, links):
+    # The names of the additional (linked) artists follow the first one
+    return """%s.name || COALESCE(' ' || (
+                   SELECT group_concat(linked.name, ' ')
+                   FROM artist AS linked
+                   JOIN %s AS link ON link.artist_id = linked.id
+                   WHERE %s), '') AS %s""" % (alias, links[0], links[1],
+                                              alias)
+
+
+def _track_links(role):
+    return ('track_artist', 'link.track_id = track.id AND link.role = %d' %
+            TrackArtistLink.ROLES.index(role))
+
+
+_ALBUM_LINKS = ('album_artist', 'link.album_id = album.id')
+
+
+# The FTS5 tables are external content tables: the indexed values are read
+# back from these views instead of being stored a second time.
+FTS_VIEWS = {
+    'albumfts_content': '''
+        SELECT album.id AS id,
+               album.uri AS uri,
+               album.name AS name,
+               %s
+        FROM album
+        JOIN artist ON artist.id = album.artists_id
+    ''' % _names('artist', _ALBUM_LINKS),
+    'trackfts_content': '''
+        SELECT track.id AS id,
+               track.uri AS uri,
+               track.name AS track_name,
+               album.name AS album,
+               %s,
+               %s,
+               %s,
+               %s,
+               track.genre AS genre,
+               track.track_no AS track_no,
+               track.date AS date,
+               track.comment AS comment
+        FROM track
+        JOIN album ON album.id = track.album_id
+        JOIN artist AS albumartist ON albumartist.id = album.artists_id
+        LEFT JOIN artist ON artist.id = track.artists_id
+        LEFT JOIN artist AS composer ON composer.id = track.composers_id
+        LEFT JOIN artist AS performer ON performer.id = track.performers_id
+    ''' % (_names('artist', _track_links('artists')),
+           _names('composer', _track_links('composers')),
+           _names('performer', _track_links('performers')),
+           _names('albumartist', _ALBUM_LINKS))
+}
+
+_ALBUMS_OF = '''SELECT id FROM album WHERE artists_id = {row}.id
+                UNION SELECT album_id FROM album_artist
+                WHERE artist_id = {row}.id'''
+
+_TRACKS_OF = {
+    'artist': '''SELECT id FROM track
+                 WHERE artists_id = {row}.id
+                 OR composers_id = {row}.id
+                 OR performers_id = {row}.id
+                 OR album_id IN (%s)
+                 OR id IN (SELECT track_id FROM track_artist
+                           WHERE artist_id = {row}.id)''' % _ALBUMS_OF,
+    'album': 'SELECT id FROM track WHERE album_id = {row}.id'
+}
+
+# table -> (indexed columns, [(fts table, ids of the rows to reindex)])
+_FTS_DEPENDENCIES = {
+    'artist': (['uri', 'name'], [
+        ('artistfts', '{row}.id'),
+        ('albumfts', _ALBUMS_OF),
+        ('trackfts', _TRACKS_OF['artist'])
+    ]),
+    'album': (['uri', 'name', 'artists_id'], [
+        ('albumfts', '{row}.id'),
+        ('trackfts', _TRACKS_OF['album'])
+    ]),
+    'track': (['uri', 'name', 'album_id', 'artists_id', 'composers_id',
+               'performers_id', 'genre', 'track_no', 'date', 'comment'], [
+        ('trackfts', '{row}.id')
+    ])
+}
+
+# link table -> [(fts table, ids of the rows to reindex)]
+_FTS_LINK_DEPENDENCIES = {
+    'track_artist': [
+        ('trackfts', '{row}.track_id')
+    ],
+    'album_artist': [
+        ('albumfts', '{row}.album_id'),
+        ('trackfts', 'SELECT id FROM track WHERE album_id = {row}.album_id')
+    ]
+}
+
+
+# Case insensitive indexes backing the exact searches and the browse
+# ordering, indexes on the other searchable columns, and composite indexes
+# matching the filter and ordering of the lookup, browse and distinct
+# queries, so that they neither scan the tables nor sort their results
+INDEXES = {
+    'artist_name_nocase': 'artist (name COLLATE NOCASE)',
+    'artist_sortkey': 'artist (COALESCE(sortname, name) COLLATE NOCASE)',
+    'album_name_nocase': 'album (name COLLATE NOCASE)',
+    'album_date': 'album (date)',
+    'album_artist_name': 'album (artists_id, name)',
+    'track_name_nocase': 'track (name COLLATE NOCASE)',
+    'track_album_disc_no': 'track (album_id, disc_no, track_no)',
+    'track_genre_name_nocase':
+        'track (genre COLLATE NOCASE, name COLLATE NOCASE)',
+    'track_genre_date': 'track (genre COLLATE NOCASE, date)',
+    'track_comment_nocase': 'track (comment COLLATE NOCASE)',
+    'track_date': 'track (date)',
+    'track_uri_mtime': 'track (uri, last_modified)'
+}
+
+# Indexes of older releases, superseded by the composite ones
+DROPPED_INDEXES = [
+    'album_artists_id',
+    'track_album_id',
+    'track_genre_nocase'
+]
+
+
+def create_indexes(db):
+    with db.atomic():
+        for name in DROPPED_INDEXES:
+            db.execute_sql('DROP INDEX IF EXISTS %s' % name)
+        for name, sql in sorted(INDEXES.items()):
+            db.execute_sql('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, sql))
+
+
+def _fts_columns(table):
+    model = dict((m._meta.table_name, m) for m in FTS_MODELS)[table]
+    return [f.column_name for f in model._meta.sorted_fields
+            if isinstance(f, SearchField)]
+
+
+def _content(table):
+    return 'artist' if table == 'artistfts' else '%s_content' % table
+
+
+def _fts_sync(table, ids, delete=False):
+    columns = ', '.join(_fts_columns(table))
+    if delete:
+        target = '%s(%s, rowid, %s)' % (table, table, columns)
+        values = "'delete', id, %s" % columns
+    else:
+        target = '%s(rowid, %s)' % (table, columns)
+        values = 'id, %s' % columns
+    return 'INSERT INTO %s SELECT %s FROM %s WHERE id IN (%s);' % (
+        target, values, _content(table), ids)
+
+
+def _body(dependencies, row, delete):
+    return '\n'.join(_fts_sync(fts, ids.format(row=row), delete)
+                     for fts, ids in dependencies)
+
+
+def _triggers():
+    for table, (columns, dependencies) in _FTS_DEPENDENCIES.items():
+        changed = ' OR '.join('old.%s IS NOT new.%s' % (c, c)
+                              for c in columns)
+
+        def body(row, delete):
+            return _body(dependencies, row, delete)
+
+        yield table + '_fts_ai', (
+            'AFTER INSERT ON %s BEGIN %s END' % (
+                table, _fts_sync(table + 'fts', 'new.id')))
+        yield table + '_fts_bu', (
+            'BEFORE UPDATE ON %s WHEN %s BEGIN %s END' % (
+                table, changed, body('old', True)))
+        yield table + '_fts_au', (
+            'AFTER UPDATE ON %s WHEN %s BEGIN %s END' % (
+                table, changed, body('new', False)))
+        yield table + '_fts_bd', (
+            'BEFORE DELETE ON %s BEGIN %s END' % (
+                table, _fts_sync(table + 'fts', 'old.id', True)))
+
+    # Links are only inserted and deleted: reindex the linked rows around
+    # each change, removing the entries while they still match the index
+    for table, dependencies in _FTS_LINK_DEPENDENCIES.items():
+        for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+            suffix = event[0].lower()
+            yield table + '_fts_b' + suffix, (
+                'BEFORE %s ON %s BEGIN %s END' % (
+                    event, table, _body(dependencies, row, True)))
+            yield table + '_fts_a' + suffix, (
+                'AFTER %s ON %s BEGIN %s END' % (
+                    event, table, _body(dependencies, row, False)))
+
+
+def create_fts_triggers(db):
+    for name, sql in _triggers():
+        db.execute_sql('CREATE TRIGGER IF NOT EXISTS %s %s' % (name, sql))
+
+
+def drop_fts_triggers(db):
+    for name, _ in _triggers():
+        db.execute_sql('DROP TRIGGER IF EXISTS %s' % name)
+
+
+def drop_legacy_fts(db):
+    """
+    Drop the FTS3/4 tables created by older releases; returns True if the
+    new FTS5 index must be rebuilt from the existing tables.
+    """
+    names = [m._meta.table_name for m in FTS_MODELS]
+    cursor = db.execute_sql(
+        'SELECT name, sql FROM sqlite_master WHERE type = ? AND name IN '
+        '(%s)' % ', '.join('?' * len(names)), ['table'] + names)
+    legacy = [name for name, sql in cursor if 'fts5' not in sql.lower()]
+    if not legacy:
+        return False
+    logger.info('local-moppina: drop legacy full-text tables %s', legacy)
+    with db.atomic():
+        for name in names:
+            db.execute_sql('DROP TABLE IF EXISTS %s' % name)
+    return True
+
+
+def _drop_outdated(db, kind, statements):
+    """
+    Drop the views or triggers whose stored definition differs from the
+    given ``name -> CREATE statement`` mapping; returns their names.
+    """
+    cursor = db.execute_sql(
+        'SELECT name, sql FROM sqlite_master WHERE type = ?', [kind])
+    stored = dict(cursor.fetchall())
+    # SQLite stores the statements without their trailing whitespace
+    outdated = [name for name, sql in statements.items()
+                if name in stored and stored[name] != sql.rstrip()]
+    for name in outdated:
+        db.execute_sql('DROP %s %s' % (kind.upper(), name))
+    return outdated
+
+
+def create_fts(db):
+    """
+    Create the full-text tables, with their content views and triggers,
+    replacing the views and triggers of older releases; returns True if
+    the views changed and the index must be rebuilt.
+    """
+    views = dict((name, 'CREATE VIEW %s AS %s' % (name, sql))
+                 for name, sql in FTS_VIEWS.items())
+    triggers = dict((name, 'CREATE TRIGGER %s %s' % (name, sql))
+                    for name, sql in _triggers())
+    with db.atomic():
+        outdated = _drop_outdated(db, 'view', views)
+        if outdated:
+            logger.info('local-moppina: update full-text views %s', outdated)
+        _drop_outdated(db, 'trigger', triggers)
+        for name, sql in sorted(FTS_VIEWS.items()):
+            db.execute_sql('CREATE VIEW IF NOT EXISTS %s AS %s' % (name, sql))
+        db.create_tables(FTS_MODELS)
+        create_fts_triggers(db)
+    return bool(outdated)
+
+
+def rebuild_fts(db):
+    logger.info('local-moppina: rebuild the full-text index')
+    with db.atomic():
+        for model in FTS_MODELS:
+            table = model._meta.table_name
+            db.execute_sql(
+                "INSERT INTO %s(%s) VALUES('rebuild')" % (table, table))
+
+
+def clear_fts(db):
+    for model in FTS_MODELS:
+        table = model._meta.table_name
+        db.execute_sql(
+            "INSERT INTO %s(%s) VALUES('delete-all')" % (table, table))
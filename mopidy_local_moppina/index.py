@@ -0,0 +1,220 @@
+from __future__ import unicode_literals
+
+import logging
+import operator
+import sys
+
+from mopidy.models import Album, Artist, Ref, Track
+
+from .utils import linked_artists
+
+
+logger = logging.getLogger(__name__)
+
+
+class ArtistRecord(object):
+    __slots__ = ('uri', 'name', 'sortname', 'musicbrainz_id', 'albums',
+                 '_model')
+
+    def __init__(self, uri, name, sortname, musicbrainz_id):
+        self.uri = uri
+        self.name = name
+        self.sortname = sortname
+        self.musicbrainz_id = musicbrainz_id
+        self.albums = []
+        self._model = None
+
+    def model(self):
+        if self._model is None:
+            self._model = Artist(uri=self.uri, name=self.name,
+                                 sortname=self.sortname,
+                                 musicbrainz_id=self.musicbrainz_id)
+        return self._model
+
+
+class AlbumRecord(object):
+    __slots__ = ('uri', 'name', 'artists', 'tracks', '_model')
+
+    def __init__(self, uri, name, artists):
+        self.uri = uri
+        self.name = name
+        self.artists = artists
+        self.tracks = []
+        self._model = None
+
+    def model(self):
+        if self._model is None:
+            self._model = Album(uri=self.uri, name=self.name,
+                                artists=[a.model() for a in self.artists])
+        return self._model
+
+
+class TrackRecord(object):
+    __slots__ = ('uri', 'name', 'album', 'artists', 'composers',
+                 'performers', 'genre', 'track_no', 'disc_no', 'date',
+                 'length', 'bitrate', 'comment', 'musicbrainz_id',
+                 'last_modified', '_model')
+
+    def __init__(self, uri, name, album, artists, composers, performers,
+                 genre, track_no, disc_no, date, length, bitrate, comment,
+                 musicbrainz_id, last_modified):
+        self.uri = uri
+        self.name = name
+        self.album = album
+        self.artists = artists
+        self.composers = composers
+        self.performers = performers
+        self.genre = genre
+        self.track_no = track_no
+        self.disc_no = disc_no
+        self.date = date
+        self.length = length
+        self.bitrate = bitrate
+        self.comment = comment
+        self.musicbrainz_id = musicbrainz_id
+        self.last_modified = last_modified
+        self._model = None
+
+    def model(self):
+        if self._model is None:
+            data = {
+                'uri': self.uri,
+                'name': self.name,
+                'genre': self.genre,
+                'track_no': self.track_no,
+                'disc_no': self.disc_no,
+                'date': self.date,
+                'length': self.length,
+                'bitrate': self.bitrate,
+                'comment': self.comment,
+                'musicbrainz_id': self.musicbrainz_id,
+                'last_modified': self.last_modified,
+                'album': self.album.model()
+            }
+            for role in ('artists', 'composers', 'performers'):
+                artists = getattr(self, role)
+                if artists:
+                    data[role] = [a.model() for a in artists]
+            self._model = Track(**data)
+        return self._model
+
+
+class LibraryIndex(object):
+    """
+    Memory resident index of the library for the lookup and browse hot
+    paths. Rows are kept as ``__slots__`` records with interned strings;
+    mopidy models are only built, once, when a record is first returned.
+    """
+
+    def __init__(self):
+        self.tracks = {}
+        self.albums = {}
+        self.artists = {}
+        self._strings = {}
+
+    def _intern(self, value):
+        if value is None:
+            return None
+        return self._strings.setdefault(value, value)
+
+    def _artist(self, artists, row):
+        record = artists.get(row.id)
+        if record is None:
+            record = artists[row.id] = ArtistRecord(
+                row.uri, self._intern(row.name), self._intern(row.sortname),
+                row.musicbrainz_id)
+            self.artists[row.uri] = record
+        return record
+
+    def _artists(self, artists, row, role):
+        return tuple(self._artist(artists, a)
+                     for a in linked_artists(row, role) if a.id is not None)
+
+    @classmethod
+    def load(cls, rows):
+        """
+        Build the index from the track rows joined with their album and
+        artists, as returned by ``Database.iter_tracks``.
+        """
+        index = cls()
+        artists = {}
+        albums = {}
+        for row in rows:
+            album = albums.get(row.album.id)
+            if album is None:
+                album_artists = index._artists(artists, row.album, 'artists')
+                album = albums[row.album.id] = AlbumRecord(
+                    row.album.uri, index._intern(row.album.name),
+                    album_artists)
+                index.albums[album.uri] = album
+                if album_artists:
+                    album_artists[0].albums.append(album)
+            track = TrackRecord(
+                row.uri, row.name, album,
+                index._artists(artists, row, 'artists'),
+                index._artists(artists, row, 'composers'),
+                index._artists(artists, row, 'performers'),
+                index._intern(row.genre), row.track_no, row.disc_no,
+                index._intern(row.date), row.length, row.bitrate,
+                index._intern(row.comment), row.musicbrainz_id,
+                row.last_modified)
+            album.tracks.append(track)
+            index.tracks[track.uri] = track
+        index._strings = None
+
+        for album in index.albums.values():
+            album.tracks.sort(key=lambda t: (t.disc_no or 0, t.track_no or 0))
+        for artist in index.artists.values():
+            artist.albums.sort(key=operator.attrgetter('name'))
+        return index
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def lookup(self, uri):
+        """
+        Return the tracks of a track, album or artist uri, None if the
+        uri is not in the index.
+        """
+        if uri in self.tracks:
+            return [self.tracks[uri].model()]
+        if uri in self.albums:
+            return [t.model() for t in self.albums[uri].tracks]
+        if uri in self.artists:
+            return [t.model() for a in self.artists[uri].albums
+                    for t in a.tracks]
+        return None
+
+    def browse(self, uri):
+        """
+        Return the albums of an artist or the tracks of an album, None if
+        the uri is not in the index.
+        """
+        if uri in self.albums:
+            return [Ref.track(uri=t.uri, name=t.name)
+                    for t in self.albums[uri].tracks]
+        if uri in self.artists:
+            return [Ref.album(uri=a.uri, name=a.name)
+                    for a in self.artists[uri].albums]
+        return None
+
+    def memory_usage(self):
+        """
+        Approximate size in bytes of the records, strings and mappings,
+        not counting the models built so far.
+        """
+        seen = set()
+        size = 0
+        for mapping in (self.tracks, self.albums, self.artists):
+            size += sys.getsizeof(mapping)
+            for record in mapping.values():
+                size += sys.getsizeof(record)
+                for name in record.__slots__:
+                    value = getattr(record, name)
+                    if isinstance(value, (list, tuple)):
+                        size += sys.getsizeof(value)
+                    elif (value is not None and not hasattr(value, 'uri')
+                          and id(value) not in seen):
+                        seen.add(id(value))
+                        size += sys.getsizeof(value)
+        return size
@@ -1,34 +1,108 @@
 from __future__ import unicode_literals
+
 import itertools
-import hashlib
 import logging
-
 import os
 import os.path
-import sqlite3
-import sys
+import time
+from collections import OrderedDict
 
 from mopidy import local
 from mopidy.exceptions import ExtensionError
-from mopidy.local import translator
 from mopidy.models import Ref, SearchResult
 
-import uritools
-from playhouse.sqlite_ext import SqliteExtDatabase
-
 from . import Extension
-from .utils import to_track, to_album, to_artist, check_track
-import db
+from .cache import LRUCache
+from .index import LibraryIndex
+from .stats import Instrumentation, instrumented
+from .utils import (ModelCache, browse_uri, check_track,
+                    split_browse_uri)
+from .writer import BackgroundWriter
 
 
 logger = logging.getLogger(__name__)
 
 
+BROWSE_INITIALS = '#ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+BROWSE_REFS = {
+    'artists': Ref.artist,
+    'albums': Ref.album,
+    'tracks': Ref.track
+}
+
+
+# For INSERT ... ON CONFLICT DO UPDATE
+SQLITE_MIN_VERSION = (3, 24, 0)
+
+# SQLite synchronous modes, from the least to the most durable
+SYNCHRONOUS_MODES = ['off', 'normal', 'full', 'extra']
+
+
+# lookup_many uri kinds -> uri looked up, given a track row
+LOOKUP_KINDS = {
+    'track': lambda row: row.uri,
+    'album': lambda row: row.album.uri,
+    'artist': lambda row: row.album.artists.uri
+}
+
+
+def _check_sqlite():
+    # The driver used by peewee, possibly pysqlite3 instead of sqlite3
+    from peewee import sqlite3
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise ExtensionError(
+            'Mopidy-Local-Moppina requires SQLite %s or newer, found %s' %
+            ('.'.join(map(str, SQLITE_MIN_VERSION)), sqlite3.sqlite_version))
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE fts USING fts5(value)')
+    except sqlite3.OperationalError:
+        raise ExtensionError('Mopidy-Local-Moppina requires SQLite built '
+                             'with the FTS5 extension')
+    finally:
+        connection.close()
+
+
+def _pragmas(ext_config):
+    # page_size must be set before switching a new database to WAL mode
+    return [
+        ('page_size', ext_config['page_size']),
+        ('journal_mode', 'wal'),
+        ('cache_size', -1024 * ext_config['cache_size']),  # KiB
+        ('mmap_size', 1024 * 1024 * ext_config['mmap_size']),
+        ('synchronous', ext_config['synchronous']),
+        ('temp_store', ext_config['temp_store']),
+        ('foreign_keys', 1),
+        ('ignore_check_constraints', 0)
+    ]
+
+
+def _normalize_query(query, exact):
+    # Full-text searches match words regardless of case and spacing, the
+    # exact ones and the uris match the values as given
+    normalized = []
+    for field, values in sorted((query or {}).items()):
+        values = ['%s' % v for v in values]
+        if not exact and field != 'uri':
+            values = [' '.join(v.lower().split()) for v in values]
+        normalized.append((field, tuple(values)))
+    return tuple(normalized)
+
+
 class MoppinaLibrary(local.Library):
 
     name = 'moppina'
 
     def __init__(self, config):
+        start = time.time()
+        # Not imported with the module, which Mopidy does when setting up
+        # the extension even if another library is used
+        from . import db
+        from .db.connection import MoppinaSqliteDatabase
+        imported = time.time()
+        _check_sqlite()
+
         self._config = ext_config = config[Extension.ext_name]
         self._data_dir = Extension.get_data_dir(config)
         try:
@@ -37,94 +111,405 @@ class MoppinaLibrary(local.Library):
             raise ExtensionError('Mopidy-Local not enabled')
 
         self._dbpath = os.path.join(self._data_dir, 'moppina.db')
-        self._connection = SqliteExtDatabase(self._dbpath, pragmas={
-            'journal_mode': 'wal',
-            'cache_size': -1 * 64000,  # 64MB
-            'foreign_keys': 1,
-            'ignore_check_constraints': 0
-        })
-        self._db = db.Database(self._connection)
+        self._connection = MoppinaSqliteDatabase(
+            self._dbpath, pragmas=_pragmas(ext_config),
+            slow_query_threshold=ext_config['slow_query_threshold'] / 1000.0)
+        self._reader = None
+        if ext_config['read_connections']:
+            self._reader = self._connection.reader()
+        self._instrumentation = None
+        if ext_config['instrumentation']:
+            self._instrumentation = Instrumentation(self._connection)
+        self._db = db.Database(self._connection, reader=self._reader,
+                               browse_limit=ext_config['browse_limit'])
+        connected = time.time()
+        self._batch_size = ext_config['batch_size']
+        self._buffer = OrderedDict()
+        self._removed = set()
+        self._scan_count = 0
+        self._scan_time = 0.0
+        self._write_count = 0
+        self._remove_count = 0
+        # Tracks actually written or deleted, unchanged ones are skipped
+        self._change_count = 0
+        self._vacuum = ext_config['vacuum']
+        self._fast_scan = ext_config['fast_scan']
+        self._scanning = False
+        self._background_writer = ext_config['background_writer']
+        self._writer = None
+        self._write_errors = 0
+        # Bumped on every library change, invalidates the cached results
+        self._generation = 0
+        self._browse_limit = ext_config['browse_limit']
+        self._search_prefix = ext_config['search_prefix']
+        self._search_cache = LRUCache(ext_config['search_cache_size'])
+        self._distinct_cache = LRUCache(ext_config['search_cache_size'])
+        self._models = ModelCache(ext_config['model_cache_size'],
+                                  lambda: self._generation)
+        self._memory_index = ext_config['memory_index']
+        self._index = None
+        self._index_generation = None
+        self._startup = OrderedDict([
+            ('imports_ms', (imported - start) * 1000),
+            ('database_ms', (connected - imported) * 1000),
+            ('total_ms', (time.time() - start) * 1000)
+        ])
+        if self._instrumentation is not None:
+            logger.info('Moppina library startup: %s', ', '.join(
+                '%s %.1f' % item for item in self._startup.items()))
         logger.info('The Moppina library has started successfully')
 
-
+    @instrumented
     def add(self, track, tags=None, duration=None):
         try:
             logger.debug('Try to add the track %s to the Moppina library', 
                          track)
-            self._db.upsert_track(check_track(track))
+            track = check_track(track)
         except Exception as e:
-            logger.exception('Failed to add %s to the Moppina library')
+            logger.exception('Failed to add %s to the Moppina library',
+                             track.uri)
+            return
+        self._scan_mode(True)
+        self._generation += 1
+        self._removed.discard(track.uri)
+        if self._background_writer:
+            self._get_writer().put(track)
+            return
+        self._buffer[track.uri] = track
+        if len(self._buffer) >= self._batch_size:
+            self.flush()
+
+    def _get_writer(self):
+        if self._writer is None:
+            self._writer = BackgroundWriter(
+                self._write, self._batch_size,
+                queue_size=2 * self._batch_size,
+                done=self._connection.close)
+        return self._writer
+
+    def _report(self, errors):
+        for error in errors:
+            self._write_errors += len(error.uris)
+            logger.error('Failed to write %d tracks to the Moppina library '
+                         '(%s ...): %s', len(error.uris), error.uris[0],
+                         error.error)
+        return not errors
     
     def begin(self):
         logger.debug('Begin scan local library with Moppina')
-        return itertools.imap(to_track, self._db.tracks())
+        return itertools.imap(self._models.convert_track,
+                              self._db.iter_tracks())
 
+    @instrumented
     def browse(self, uri):
-        logger.info('Browse Moppina library for uri %s', uri)
+        logger.debug('Browse Moppina library for uri %s', uri)
         try:
             if uri == self.ROOT_DIRECTORY_URI:
                 return [
                     Ref.directory(uri='local:artists', name='Artists'),
                     Ref.directory(uri='local:albums', name='Albums'),
-                    Ref.directory(uri='local:tracks', name='Tracks')
+                    Ref.directory(uri='local:tracks', name='Tracks'),
+                    Ref.directory(uri='local:genres', name='Genres'),
+                    Ref.directory(uri='local:years', name='Years')
                 ]
-            elif uri.startswith('local:artists'):
-                return [Ref.artist(uri=a.uri, name=a.name) \
-                    for a in self._db.artists()]
-            elif uri.startswith('local:albums'):
-                return [Ref.album(uri=a.uri, name=a.name) \
-                    for a in self._db.albums()]
-            elif uri.startswith('local:tracks'):
-                return [Ref.track(uri=t.uri, name=t.name) \
-                    for t in self._db.tracks()]
-            elif uri.startswith('local:artist'):
-                return [Ref.album(uri=a.uri, name=a.name) \
-                    for a in self._db.albums_by_artist(uri)]
-            elif uri.startswith('local:album'):
-                return [Ref.track(uri=t.uri, name=t.name) \
-                    for t in self._db.tracks_by_album(uri)]
+            path, params = split_browse_uri(uri)
+            if path in BROWSE_REFS:
+                return self._browse_listing(path, params)
+            elif path == 'genres':
+                return self._paged(path, params, [
+                    Ref.directory(uri=browse_uri('tracks', genre=g), name=g)
+                    for g in self._db.genres()])
+            elif path == 'years':
+                return self._paged(path, params, [
+                    Ref.directory(uri=browse_uri('albums', year=y), name=y)
+                    for y in self._db.years()])
+            base = 'local:' + path
+            index = self._current_index()
+            refs = index.browse(base) if index is not None else None
+            if refs is not None:
+                return self._paged(path, params, refs)
+            elif path.startswith('artist:'):
+                return self._paged(path, params, [
+                    Ref.album(uri=a.uri, name=a.name)
+                    for a in self._db.albums_by_artist(base)])
+            elif path.startswith('album:'):
+                return self._paged(path, params, [
+                    Ref.track(uri=t.uri, name=t.name)
+                    for t in self._db.tracks_by_album(base)])
             else:
                 raise ValueError('Invalid browse URI')
         except Exception as e:
             logger.error('Error while browsing Moppina library for %s: %s', 
                          uri, e)
             return []
-    
+
+    def _page_directories(self, path, params, count):
+        """
+        Directories of the pages of ``count`` entries, or of a span of
+        ``pages`` pages: spans of pages are nested in turn, so that no
+        more than browse_limit directories are returned.
+        """
+        limit = self._browse_limit
+        first = int(params.pop('page', 0))
+        pages = int(params.pop('pages', 0)) or (count + limit - 1) // limit
+        size = 1
+        while size * limit < pages:
+            size *= max(limit, 2)
+        refs = []
+        for page in range(first, first + pages, size):
+            span = min(size, first + pages - page)
+            if span == 1:
+                refs.append(Ref.directory(
+                    uri=browse_uri(path, page=page, **params),
+                    name='Page %d' % (page + 1)))
+            else:
+                refs.append(Ref.directory(
+                    uri=browse_uri(path, page=page, pages=span, **params),
+                    name='Pages %d-%d' % (page + 1, page + span)))
+        return refs
+
+    def _paged(self, path, params, refs):
+        """
+        Return a page of ``refs``, given the page parameter, or their
+        page directories if there are more than browse_limit of them.
+        """
+        limit = self._browse_limit
+        if 'page' in params and 'pages' not in params:
+            offset = int(params['page']) * limit
+            return refs[offset:offset + limit]
+        if len(refs) > limit or 'pages' in params:
+            return self._page_directories(path, params, len(refs))
+        return refs
+
+    def _browse_listing(self, kind, params):
+        """
+        List artists, albums or tracks, split in A-Z buckets and pages so
+        that no more than browse_limit refs are returned.
+        """
+        limit = self._browse_limit
+        page = params.get('page') if 'pages' not in params else None
+        filters = dict((k, v) for k, v in params.items()
+                       if k not in ('page', 'pages'))
+        qs = self._db.browse(kind, **filters)
+        ref = BROWSE_REFS[kind]
+
+        if page is not None:
+            qs = qs.limit(limit).offset(int(page) * limit)
+        else:
+            count = qs.count()
+            if count > limit and not params and \
+                    limit >= len(BROWSE_INITIALS):
+                return [Ref.directory(uri=browse_uri(kind, initial=i),
+                                      name=i)
+                        for i in BROWSE_INITIALS]
+            if count > limit or 'pages' in params:
+                return self._page_directories(kind, params, count)
+
+        return [ref(uri=r.uri, name=r.name) for r in qs]
+
+    @instrumented
     def clear(self):
         logger.info('Clear the Moppina library database')
+        # Pending tracks are discarded, only the background writer is
+        # drained, as it may be writing
+        self._buffer.clear()
+        self._removed.clear()
+        if self._writer is not None:
+            self._report(self._writer.join())
+        self._generation += 1
         self._db.clear()
         return True
     
     def close(self):
         logger.info('Close the Moppina library database')
-        self._db.close()
+        start = time.time()
+        self.flush()
+        if self._writer is not None:
+            self._report(self._writer.stop())
+            self._writer = None
+        if self._write_errors:
+            logger.error('Moppina library failed to write %d tracks',
+                         self._write_errors)
+        if self._change_count:
+            self._generation += 1
+            self._db.delete_orphans()
+            if self._vacuum:
+                self._db.vacuum()
+        self._scan_mode(False)
+        if self._remove_count:
+            logger.info('Moppina library removed %d tracks',
+                        self._remove_count)
+        if self._scan_count:
+            logger.info('Moppina library wrote %d of %d scanned tracks in '
+                        '%.1fs (%.1f tracks/s), the others were unchanged',
+                        self._write_count, self._scan_count, self._scan_time,
+                        self._write_count / (self._scan_time or 1e-9))
+        logger.debug('Moppina library cache stats: %s',
+                     self._db.cache_stats())
+        if self._instrumentation is not None:
+            logger.info('Moppina library stats: %s', self.stats())
+        self._db.close(self._change_count)
+        if self._instrumentation is not None:
+            logger.info('Moppina library closed in %.1fms',
+                        (time.time() - start) * 1000)
 
+    def _scan_mode(self, enabled):
+        """
+        Switch to the normal synchronous mode while scanning, which in WAL
+        mode trades durability of the last written batches for throughput
+        but is safe from corruption, and restore the configured mode when
+        the scan is over.
+        """
+        if not self._fast_scan or enabled == self._scanning:
+            return
+        self._scanning = enabled
+        synchronous = self._config['synchronous']
+        if enabled and SYNCHRONOUS_MODES.index(synchronous) > \
+                SYNCHRONOUS_MODES.index('normal'):
+            synchronous = 'normal'
+        logger.debug('Moppina library synchronous mode: %s', synchronous)
+        # Also applied to the connections opened later, e.g. by the writer
+        self._connection.pragma('synchronous', synchronous, permanent=True)
+
+    @instrumented
     def flush(self):
+        if self._writer is not None:
+            written = self._report(self._writer.join())
+        else:
+            written = self._flush_buffer()
+        # Removed last, so that a track queued before being removed
+        # doesn't come back
+        return self._flush_removed() and written
+
+    def _flush_buffer(self):
+        if not self._buffer:
+            return True
+        tracks = list(self._buffer.values())
+        self._buffer.clear()
+        try:
+            self._write(tracks)
+        except Exception:
+            logger.exception('Failed to flush %d tracks to the Moppina '
+                             'library', len(tracks))
+            self._write_errors += len(tracks)
+            return False
         return True
 
+    def _flush_removed(self):
+        if not self._removed:
+            return True
+        uris = list(self._removed)
+        self._removed.clear()
+        try:
+            count = self._db.delete_tracks(uris)
+        except Exception:
+            logger.exception('Failed to remove %d tracks from the Moppina '
+                             'library', len(uris))
+            return False
+        self._generation += 1
+        self._remove_count += count
+        self._change_count += count
+        return True
+
+    def _write(self, tracks):
+        start = time.time()
+        written = self._db.upsert_tracks(tracks)
+        # Drop the results cached while the tracks were being written
+        self._generation += 1
+        elapsed = time.time() - start
+        self._scan_count += len(tracks)
+        self._write_count += written
+        self._change_count += written
+        self._scan_time += elapsed
+        logger.debug('Moppina library flushed %d tracks, wrote %d in %.2fs '
+                     '(%.1f tracks/s)', len(tracks), written, elapsed,
+                     written / (elapsed or 1e-9))
+
+    @instrumented
     def get_distinct(self, field, query=None):
-        logger.info('Moppina library get distinct for %s: %s', field, query)
-        return self._db.get_distinct(field, query or {})
+        logger.debug('Moppina library get distinct for %s: %s', field, query)
+        key = (self._generation, field, _normalize_query(query, True))
+        result = self._distinct_cache.get(key)
+        if result is None:
+            result = self._db.get_distinct(field, query or {})
+            self._distinct_cache.put(key, result)
+        return set(result)
+
+    def stats(self):
+        """
+        Return the latency histograms and SQL statement counts of the
+        public calls, together with the cache statistics. The call stats
+        are only collected when the instrumentation setting is enabled.
+        """
+        stats = {
+            'write_errors': self._write_errors,
+            'search_cache': self._search_cache.stats(),
+            'distinct_cache': self._distinct_cache.stats(),
+            'db_cache': self._db.cache_stats(),
+            'model_cache': self._models.stats(),
+            'startup': self._startup
+        }
+        if self._instrumentation is not None:
+            stats.update(self._instrumentation.stats())
+        return stats
 
+    @instrumented
     def load(self):
         logger.debug('Load the Moppina library')
+        # The library may have been changed by another process, e.g. by
+        # mopidy local scan, drop the results cached until now
+        self._generation += 1
+        if self._memory_index:
+            return self._load_index()
         track_count = self._db.tracks_count()
         logger.info('%s tracks has been loaded by Moppina library', 
                     track_count)
         return track_count
 
+    def _load_index(self):
+        generation = self._generation
+        start = time.time()
+        self._index = LibraryIndex.load(self._db.iter_tracks())
+        self._index_generation = generation
+        track_count = len(self._index)
+        size = self._index.memory_usage() / float(1 << 20)
+        logger.info('%s tracks has been loaded by Moppina library in %.1fs, '
+                    'index size %.1fMB (%.1fMB per 100k tracks)',
+                    track_count, time.time() - start, size,
+                    size * 100000 / (track_count or 1))
+        return track_count
+
+    def _current_index(self):
+        # The index is ignored once the library changed after loading it
+        if self._index_generation == self._generation:
+            return self._index
+        return None
+
+    @instrumented
+    def mtimes(self):
+        """
+        Return a ``uri -> last_modified`` mapping of the stored tracks,
+        without building any track model.
+        """
+        return dict(self._db.track_mtimes())
+
+    @instrumented
     def lookup(self, uri):
-        logger.info('Lookup Moppina library for %s', uri)
-        if uri.startswith('local:album'):
-            return list(itertools.imap(to_track, 
+        logger.debug('Lookup Moppina library for %s', uri)
+        index = self._current_index()
+        tracks = index.lookup(uri) if index is not None else None
+        if tracks is not None:
+            return tracks
+        elif uri.startswith('local:album'):
+            return list(itertools.imap(self._models.to_track,
                 self._db.tracks_by_album(uri)
             ))
         elif uri.startswith('local:artist'):
-            return list(itertools.imap(to_track, 
+            return list(itertools.imap(self._models.to_track,
                 self._db.tracks_by_artist(uri)
             ))
         elif uri.startswith('local:track'):
-            return list(itertools.imap(to_track, 
+            return list(itertools.imap(self._models.to_track,
                 self._db.track_by_uri(uri)
             ))
         else:
@@ -132,15 +517,62 @@ class MoppinaLibrary(local.Library):
                          'invalid lookup URI %s', uri)
             return []
 
+    @instrumented
+    def lookup_many(self, uris):
+        """
+        Lookup many track, album or artist uris at once, e.g. to load a
+        playlist, with a single query per kind of uri (or per chunk of
+        uris, for very long lists). Returns a ``uri -> tracks`` mapping.
+        """
+        result = OrderedDict((uri, []) for uri in uris)
+        index = self._current_index()
+        groups = dict((kind, []) for kind in LOOKUP_KINDS)
+        for uri in result:
+            tracks = index.lookup(uri) if index is not None else None
+            if tracks is not None:
+                result[uri] = tracks
+                continue
+            kind = uri.split(':')[1] if uri.startswith('local:') else None
+            if kind in groups:
+                groups[kind].append(uri)
+            else:
+                logger.error('Error looking up the Moppina library: '
+                             'invalid lookup URI %s', uri)
+
+        for kind, kind_uris in groups.items():
+            key = LOOKUP_KINDS[kind]
+            for row in self._db.tracks_by_uris(kind, kind_uris):
+                result[key(row)].append(self._models.to_track(row))
+        return result
+
+    @instrumented
     def remove(self, uri):
-        logger.info('Remove %s from the Moppina library')
-        self._db.delete_track(uri)
+        logger.debug('Remove %s from the Moppina library', uri)
+        self._scan_mode(True)
+        self._buffer.pop(uri, None)
+        self._removed.add(uri)
+        self._generation += 1
+        if len(self._removed) >= self._batch_size:
+            self.flush()
     
-    def search(self, query, limit=100, offset=0, exact=False, uris=None):
-        logger.info('Search the Moppina library for %s: %s', query, exact)
+    @instrumented
+    def search(self, query, limit=100, offset=0, exact=False, uris=None,
+               prefix=None):
+        logger.debug('Search the Moppina library for %s: %s', query, exact)
+        if prefix is None:
+            prefix = self._search_prefix
+        key = (self._generation, _normalize_query(query, exact), exact,
+               prefix and not exact, limit, offset, tuple(uris or ()))
+        result = self._search_cache.get(key)
+        if result is None:
+            result = self._search(query, limit, offset, exact, uris, prefix)
+            self._search_cache.put(key, result)
+        return result
+
+    def _search(self, query, limit, offset, exact, uris, prefix):
         if not query:
-            tracks = self._db.tracks().limit(limit).offset(offset)
-            mopidy_tracks = itertools.imap(to_track, tracks)
+            tracks = self._db.tracks_slice(limit, offset, uris)
+            mopidy_tracks = itertools.imap(self._models.to_track, tracks)
             return SearchResult(uri='local:search', tracks=mopidy_tracks)
         
         artists = []
@@ -148,13 +580,15 @@ class MoppinaLibrary(local.Library):
         tracks = []
 
         if exact:
-            artists, albums, tracks = self._db.search(query, limit, offset)
+            artists, albums, tracks = self._db.search(query, limit, offset,
+                                                      uris)
         else:
-            artists, albums, tracks = self._db.fts_search(query, limit, offset)
+            artists, albums, tracks = self._db.fts_search(query, limit, offset,
+                                                          prefix, uris)
 
-        mopidy_artists = list(itertools.imap(to_artist, artists))
-        mopidy_albums = list(itertools.imap(to_album, albums))
-        mopidy_tracks = list(itertools.imap(to_track, tracks))
+        mopidy_artists = list(itertools.imap(self._models.to_artist, artists))
+        mopidy_albums = list(itertools.imap(self._models.to_album, albums))
+        mopidy_tracks = list(itertools.imap(self._models.to_track, tracks))
         return SearchResult(uri='local:search', 
                             artists=mopidy_artists,
                             albums=mopidy_albums,
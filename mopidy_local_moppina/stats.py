@@ -0,0 +1,90 @@
+from __future__ import unicode_literals
+
+import bisect
+import functools
+import time
+from collections import OrderedDict
+
+
+# Upper bounds (in milliseconds) of the latency histogram buckets
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed, roughly logarithmic buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def stats(self):
+        labels = ['<=%dms' % b for b in BUCKETS] + ['>%dms' % BUCKETS[-1]]
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'max_ms': self.max,
+            'histogram': OrderedDict((label, count) for label, count
+                                     in zip(labels, self.counts) if count)
+        }
+
+
+class Instrumentation(object):
+    """
+    Latency histograms and SQL statement counts of the instrumented calls,
+    collected only when instrumentation is enabled.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._latency = {}
+        self._queries = {}
+
+    def record(self, name, seconds, queries):
+        self._latency.setdefault(name, Histogram()).add(seconds)
+        self._queries[name] = self._queries.get(name, 0) + queries
+
+    def stats(self):
+        calls = {}
+        for name, histogram in self._latency.items():
+            calls[name] = histogram.stats()
+            calls[name]['queries'] = self._queries[name]
+            calls[name]['queries_per_call'] = (
+                float(self._queries[name]) / histogram.count)
+        return {
+            'calls': calls,
+            'queries': self._connection.query_count,
+            'slow_queries': self._connection.slow_query_count
+        }
+
+
+def instrumented(func):
+    """
+    Record latency and SQL statement count of a method of an object with
+    an ``_instrumentation`` attribute; a no-op when that is None.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        instrumentation = self._instrumentation
+        if instrumentation is None:
+            return func(self, *args, **kwargs)
+        connection = self._connection
+        queries = connection.query_count
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            instrumentation.record(func.__name__, time.time() - start,
+                                   connection.query_count - queries)
+    return wrapper
@@ -4,6 +4,21 @@ from hashlib import md5
 from mopidy.models import Artist, Album, Track
 from mopidy.local import translator
 
+import uritools
+
+from .cache import LRUCache
+
+
+def linked_artists(row, role):
+    """
+    All the artists of a track or album row in ``role``: the one it
+    references first, then the additional linked ones.
+    """
+    first = getattr(row, role)
+    artists = [first] if first else []
+    return artists + getattr(row, 'linked', {}).get(role, [])
+
+
 def to_artist(a):
     return  Artist(
         uri=a.uri,
@@ -12,14 +27,20 @@ def to_artist(a):
         musicbrainz_id=a.musicbrainz_id
     )
 
-def to_album(a):
+
+def to_album(a, artist=to_artist):
     return Album(
         uri=a.uri,
         name=a.name,
-        artists=[to_artist(a.artists)] if a.artists else []
-    )    
+        artists=map(artist, linked_artists(a, 'artists'))
+    )
+
 
-def to_track(t):
+def to_track(t, album=to_album, artist=to_artist):
+    """
+    Build a Track from a track row, converting its album and artists
+    through ``album`` and ``artist``.
+    """
     data = {
         'uri': t.uri,
         'name': t.name,
@@ -32,26 +53,117 @@ def to_track(t):
         'comment': t.comment,
         'musicbrainz_id': t.musicbrainz_id,
         'last_modified': t.last_modified,
-        'album': to_album(t.album)
+        'album': album(t.album)
     }
 
-    if t.artists:
-        data['artists'] = [to_artist(t.artists)]
-    if t.composers:
-        data['composers'] = [to_artist(t.composers)]
-    if t.performers:
-        data['performers'] = [to_artist(t.performers)]
-
+    for role in ('artists', 'composers', 'performers'):
+        artists = linked_artists(t, role)
+        if artists:
+            data[role] = map(artist, artists)
 
     return Track(**data)
 
 
+class ModelCache(object):
+    """
+    Row to model conversions sharing the Artist, Album and Track models
+    built for the same rows. Entries are keyed by row id and library
+    generation, so the models of changed rows are never returned.
+    """
+
+    def __init__(self, maxsize=10000, generation=lambda: 0):
+        self._generation = generation
+        self._artists = LRUCache(maxsize)
+        self._albums = LRUCache(maxsize)
+        self._tracks = LRUCache(maxsize)
+
+    def _cached(self, cache, convert, row):
+        if row.id is None:
+            return convert(row)
+        key = (self._generation(), row.id)
+        model = cache.get(key)
+        if model is None:
+            model = convert(row)
+            cache.put(key, model)
+        return model
+
+    def to_artist(self, a):
+        return self._cached(self._artists, to_artist, a)
+
+    def to_album(self, a):
+        return self._cached(self._albums, self._convert_album, a)
+
+    def to_track(self, t):
+        return self._cached(self._tracks, self.convert_track, t)
+
+    def _convert_album(self, a):
+        return to_album(a, self.to_artist)
+
+    def convert_track(self, t):
+        """
+        Build a new Track sharing the cached album and artists, without
+        caching the track itself, e.g. when iterating the whole library.
+        """
+        return to_track(t, self.to_album, self.to_artist)
+
+    def clear(self):
+        self._artists.clear()
+        self._albums.clear()
+        self._tracks.clear()
+
+    def stats(self):
+        return {
+            'artists': self._artists.stats(),
+            'albums': self._albums.stats(),
+            'tracks': self._tracks.stats()
+        }
+
+
+def browse_uri(path, **params):
+    return uritools.uricompose(scheme='local', path=path,
+                               query=sorted(params.items()) or None)
+
+
+def split_browse_uri(uri):
+    """
+    Split a browse uri into its path, e.g. ``tracks`` or ``album:...``,
+    and the mapping of its query parameters.
+    """
+    parts = uritools.urisplit(uri)
+    params = dict((k, v[-1]) for k, v in parts.getquerydict().items())
+    return parts.path, params
+
+
 def calc_uri(model, data):
     return 'local:{}:md5:{}'.format(
         model,
         md5(str(data)).hexdigest()
     )
 
+
+def _artist_keys(artists):
+    # Mopidy keeps the artists in sets, whose order varies between equal
+    # tracks: sort them
+    return sorted((a.uri, a.name, a.sortname, a.musicbrainz_id)
+                  for a in artists or ())
+
+
+def fingerprint(track):
+    """
+    Digest of a checked track content, not affected by its mtime.
+    """
+    album = track.album
+    content = (
+        track.uri, track.name, track.genre, track.track_no, track.disc_no,
+        track.date, track.length, track.bitrate, track.comment,
+        track.musicbrainz_id, _artist_keys(track.artists),
+        _artist_keys(track.composers), _artist_keys(track.performers),
+        (album.uri, album.name, album.num_tracks, album.num_discs,
+         album.date, album.musicbrainz_id, sorted(album.images or ()),
+         _artist_keys(album.artists))
+    )
+    return md5(repr(content)).hexdigest()
+
 def check_artist(artist):
     if not artist.name:
         raise ValueError('No artist name')
@@ -76,6 +188,8 @@ def check_track(track):
             albumartist = map(check_artist, track.album.artists)
         else:
             albumartist = map(check_artist, track.artists)
+        if not albumartist:
+            raise ValueError('album without artists')
         album = track.album.copy(
             uri=track.album.uri or calc_uri('album', track.album),
             artists=albumartist
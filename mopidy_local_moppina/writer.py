@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import OrderedDict
+
+from mopidy.compat import queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteError(object):
+    """
+    A batch of tracks that could not be written.
+    """
+
+    def __init__(self, uris, error):
+        self.uris = uris
+        self.error = error
+
+    def __repr__(self):
+        return '<WriteError %d tracks: %s>' % (len(self.uris), self.error)
+
+
+class BackgroundWriter(object):
+    """
+    Write the queued tracks from a dedicated thread, in batches of up to
+    ``batch_size`` tracks. The queue is bounded, so the producer is
+    throttled when the writes can't keep up with it.
+
+    ``write`` is called with each batch from the writer thread, and
+    ``done`` once when the thread stops, e.g. to close its connection.
+    """
+
+    def __init__(self, write, batch_size, queue_size, done=None):
+        self._write = write
+        self._done = done
+        self._batch_size = batch_size
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._thread = threading.Thread(target=self._run,
+                                        name='MoppinaWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, track):
+        self._queue.put(track)
+
+    def join(self):
+        """
+        Wait for the queued tracks to be written and return the errors
+        collected since the last call.
+        """
+        self._queue.join()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def stop(self):
+        errors = self.join()
+        self._queue.put(None)
+        self._thread.join()
+        return errors
+
+    def _batch(self, track):
+        # Only the last version of a track queued twice is written
+        batch = OrderedDict([(track.uri, track)])
+        count = 1
+        while count < self._batch_size:
+            try:
+                track = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if track is None:
+                # Stop after writing this batch
+                self._queue.put(None)
+                self._queue.task_done()
+                break
+            count += 1
+            batch[track.uri] = track
+        return batch, count
+
+    def _run(self):
+        try:
+            while True:
+                track = self._queue.get()
+                if track is None:
+                    self._queue.task_done()
+                    break
+                batch, count = self._batch(track)
+                try:
+                    self._write(list(batch.values()))
+                except Exception as e:
+                    logger.debug('Moppina library failed to write %d '
+                                 'tracks', len(batch), exc_info=True)
+                    with self._lock:
+                        self._errors.append(WriteError(list(batch), e))
+                finally:
+                    for _ in range(count):
+                        self._queue.task_done()
+        finally:
+            if self._done is not None:
+                self._done()
@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 
-from mopidy_local_moppina import Extension, frontend as frontend_lib
+import pytest
+
+from mopidy_local_moppina import Extension
 
 
 def test_get_default_config():
@@ -17,9 +19,26 @@ def test_get_config_schema():
 
     schema = ext.get_config_schema()
 
-    # TODO Test the content of your config schema
-    #assert 'username' in schema
-    #assert 'password' in schema
+    assert 'batch_size' in schema
+    assert 'browse_limit' in schema
+    assert 'search_prefix' in schema
+    assert 'search_cache_size' in schema
+    assert 'model_cache_size' in schema
+    assert 'instrumentation' in schema
+    assert 'slow_query_threshold' in schema
+    assert 'cache_size' in schema
+    assert 'mmap_size' in schema
+    assert 'page_size' in schema
+    assert 'synchronous' in schema
+    assert 'temp_store' in schema
+    assert 'fast_scan' in schema
+    assert 'read_connections' in schema
+    assert 'background_writer' in schema
+    assert 'memory_index' in schema
+    assert 'vacuum' in schema
+
+    with pytest.raises(ValueError):
+        schema['browse_limit'].deserialize('1')
 
 
 # TODO Write more tests
@@ -0,0 +1,634 @@
+from __future__ import unicode_literals
+
+from mopidy.exceptions import ExtensionError
+from mopidy.models import Album, Artist, Track
+
+import peewee
+
+import pytest
+
+from mopidy_local_moppina.db import schema
+from mopidy_local_moppina.db.migrations import SCHEMA_VERSION
+from mopidy_local_moppina.library import MoppinaLibrary
+from mopidy_local_moppina.utils import fingerprint
+
+
+ARTISTS = [
+    Artist(uri='local:artist:a%d' % i, name='Artist %d' % i)
+    for i in range(3)
+]
+
+ALBUMS = [
+    Album(uri='local:album:b%d' % i, name='Album %d' % i,
+          artists=[ARTISTS[i % len(ARTISTS)]])
+    for i in range(6)
+]
+
+TRACKS = [
+    Track(uri='local:track:album%d/track%d.mp3' % (i % 6, i),
+          name='Track %d' % i,
+          album=ALBUMS[i % 6],
+          artists=[ARTISTS[i % len(ARTISTS)]],
+          composers=[ARTISTS[(i + 1) % len(ARTISTS)]],
+          genre='Rock' if i % 2 else 'Jazz',
+          track_no=i // 6 + 1,
+          date='19%02d' % (70 + i % 6),
+          last_modified=i)
+    for i in range(30)
+]
+
+
+@pytest.fixture
+def config(tmpdir):
+    return {
+        'core': {
+            'data_dir': str(tmpdir)
+        },
+        'local': {
+            'media_dir': str(tmpdir)
+        },
+        'local-moppina': {
+            'batch_size': 10,
+            'browse_limit': 27,
+            'search_prefix': False,
+            'search_cache_size': 10,
+            'model_cache_size': 100,
+            'instrumentation': True,
+            'slow_query_threshold': 0,
+            'cache_size': 8,
+            'mmap_size': 16,
+            'page_size': 8192,
+            'synchronous': 'normal',
+            'temp_store': 'memory',
+            'fast_scan': True,
+            'read_connections': True,
+            'background_writer': False,
+            'memory_index': False,
+            'vacuum': False
+        }
+    }
+
+
+@pytest.fixture
+def library(config):
+    library = MoppinaLibrary(config)
+    for track in TRACKS:
+        library.add(track)
+    library.flush()
+    yield library
+    library.close()
+
+
+def count_queries(library, func, *args, **kwargs):
+    connection = library._connection
+    before = connection.query_count
+    result = func(*args, **kwargs)
+    return connection.query_count - before, result
+
+
+def test_begin_single_query(library):
+    count, tracks = count_queries(library, lambda: list(library.begin()))
+
+    assert count == 1
+    assert len(tracks) == len(TRACKS)
+
+
+def test_lookup_single_query(library):
+    for uri, expected in [(TRACKS[0].uri, 1),
+                          (ALBUMS[0].uri, 5),
+                          (ARTISTS[0].uri, 10)]:
+        count, tracks = count_queries(library, library.lookup, uri)
+
+        assert count == 1
+        assert len(tracks) == expected
+        assert all(t.album.artists for t in tracks)
+        assert all(t.artists and t.composers for t in tracks)
+
+
+def test_fingerprint():
+    artists = [Artist(uri='local:artist:f%d' % i, name='Artist %d' % i)
+               for i in range(20)]
+    track = TRACKS[0].copy(artists=artists, performers=artists[:10])
+    # Artists whose set order depends on their insertion order
+    pair = next([a, b] for a in artists for b in artists
+                if list(frozenset([a, b])) != list(frozenset([b, a])))
+
+    assert fingerprint(track) == fingerprint(TRACKS[0].copy(
+        artists=artists[::-1], performers=artists[9::-1]))
+    # Mopidy shares the equal models alive, release the first track
+    first = fingerprint(track.copy(composers=pair))
+    assert first == fingerprint(track.copy(composers=pair[::-1]))
+    assert fingerprint(track) == fingerprint(track.copy(last_modified=1))
+    assert fingerprint(track) != fingerprint(track.copy(
+        performers=artists[:9]))
+    assert fingerprint(track) != fingerprint(track.copy(
+        album=track.album.copy(name='Changed')))
+
+
+def test_search_queries(library):
+    count, result = count_queries(library, library.search,
+                                  {'track_name': ['Track']})
+
+    assert count <= 6
+    assert len(result.tracks) == len(TRACKS)
+
+
+def test_search_uri(library):
+    result = library.search({'uri': ['album3']})
+    assert sorted(t.uri for t in result.tracks) == sorted(
+        t.uri for t in TRACKS if t.album == ALBUMS[3])
+    assert not result.albums and not result.artists
+
+    result = library.search({'uri': ['album3'], 'track_name': ['track 3']})
+    assert [t.uri for t in result.tracks] == [TRACKS[3].uri]
+
+
+def test_search_prefix(library):
+    result = library.search({'artist': ['Artis']}, prefix=True)
+
+    assert len(result.artists) == len(ARTISTS)
+    assert not library.search({'artist': ['Artis']}).artists
+
+
+def test_search_cache(library):
+    query = {'album': ['Album 1']}
+    result = library.search(query)
+
+    assert count_queries(library, library.search, query) == (0, result)
+
+    library.add(TRACKS[0].copy(name='Changed'))
+
+    assert count_queries(library, library.search, query)[0] > 0
+
+    library.add(TRACKS[0].copy(name='Foo  Bar'))
+    library.add(TRACKS[1].copy(name='Foo Bar'))
+    library.flush()
+    for name, track in [('Foo  Bar', TRACKS[0]), ('Foo Bar', TRACKS[1])]:
+        result = library.search({'track_name': [name]}, exact=True)
+        assert [t.uri for t in result.tracks] == [track.uri]
+        assert library.get_distinct('album', {'track_name': [name]}) == \
+            {track.album.name}
+
+
+def test_failed_write(config, monkeypatch):
+    library = MoppinaLibrary(config)
+    upsert_tracks = library._db._upsert_tracks
+
+    def fail(*args):
+        monkeypatch.setattr(library._db, '_upsert_tracks', upsert_tracks)
+        raise ValueError('write failed')
+
+    monkeypatch.setattr(library._db, '_upsert_tracks', fail)
+    for track in TRACKS[:5]:
+        library.add(track)
+    assert not library.flush()
+    assert not list(library.begin())
+
+    # The ids of the rolled back artists and albums are not reused
+    for track in TRACKS[:5]:
+        library.add(track)
+    assert library.flush()
+    assert len(list(library.begin())) == 5
+    library.close()
+
+
+def test_search_uris(library):
+    query = {'track_name': ['Track']}
+
+    result = library.search(query, uris=[ALBUMS[0].uri])
+    assert len(result.tracks) == 5
+
+    result = library.search(query, uris=[ARTISTS[0].uri, ALBUMS[1].uri])
+    assert len(result.tracks) == 15
+
+    result = library.search(query, uris=['local:directory:album2'])
+    assert [t.album for t in result.tracks] == [ALBUMS[2]] * 5
+
+    result = library.search(query, uris=['local:tracks?genre=Jazz'])
+    assert set(t.genre for t in result.tracks) == {'Jazz'}
+    assert len(result.tracks) == 15
+
+    result = library.search(query, uris=['local:albums?year=1972'])
+    assert [t.album for t in result.tracks] == [ALBUMS[2]] * 5
+
+    result = library.search(query, uris=[TRACKS[0].uri])
+    assert [t.uri for t in result.tracks] == [TRACKS[0].uri]
+
+    assert not library.search(query, uris=['local:unknown']).tracks
+    assert len(library.search(query, uris=['local:directory']).tracks) == 30
+
+
+def test_search_exact(library):
+    result = library.search({'artist': ['artist 0']}, exact=True)
+    assert list(result.artists) == [ARTISTS[0]]
+    assert len(result.tracks) == 10
+
+    result = library.search({'any': ['ALBUM 2']}, exact=True)
+    assert [a.uri for a in result.albums] == [ALBUMS[2].uri]
+    assert len(result.tracks) == 5
+
+    result = library.search({'albumartist': ['Artist 1'],
+                             'track_no': ['2']}, exact=True)
+    assert sorted(t.name for t in result.tracks) == ['Track 10', 'Track 7']
+
+    result = library.search({'genre': ['Blues']}, exact=True)
+    assert not result.tracks
+
+
+def test_get_distinct(library):
+    assert library.get_distinct('genre') == {'Rock', 'Jazz'}
+    assert library.get_distinct('albumartist') == \
+        {a.name for a in ARTISTS}
+    assert library.get_distinct('album', {'artist': ['Artist 1']}) == \
+        {'Album 1', 'Album 4'}
+    assert library.get_distinct('composer', {'album': ['Album 0']}) == \
+        {'Artist 1'}
+    assert library.get_distinct('date', {'genre': ['Blues']}) == set()
+    assert library.get_distinct('unknown') == set()
+
+    assert count_queries(library, library.get_distinct, 'genre')[0] == 0
+
+
+def test_browse(library):
+    assert len(library.browse('local:artists')) == len(ARTISTS)
+    assert len(library.browse(ALBUMS[0].uri)) == 5
+
+    buckets = library.browse('local:tracks')
+    assert [r.name for r in buckets][:2] == ['#', 'A']
+    tracks = library.browse('local:tracks?initial=T')
+    assert [r.name for r in tracks] == ['Page 1', 'Page 2']
+    tracks = [t for page in tracks for t in library.browse(page.uri)]
+    assert len(tracks) == len(TRACKS)
+    assert [t.name for t in tracks] == sorted(t.name for t in TRACKS)
+
+    names = ['Zebra', 'zoo', '1999', '_x', '[y', '~z']
+    for name in names:
+        library.add(TRACKS[0].copy(uri='local:track:%s.mp3' % name,
+                                   name=name))
+    library.flush()
+    refs = library.browse('local:tracks?initial=Z')
+    assert [r.name for r in refs] == ['Zebra', 'zoo']
+    refs = library.browse('local:tracks?initial=%23')
+    assert sorted(r.name for r in refs) == ['1999', '[y', '_x', '~z']
+    for name in names:
+        library.remove('local:track:%s.mp3' % name)
+    library.flush()
+
+    genres = library.browse('local:genres')
+    assert [g.name for g in genres] == ['Jazz', 'Rock']
+    assert len(library.browse(genres[0].uri)) == 15
+
+    years = library.browse('local:years')
+    assert len(years) == 6
+    assert [a.name for a in library.browse(years[0].uri)] == ['Album 0']
+
+
+def test_browse_limit(config):
+    config['local-moppina']['browse_limit'] = 5
+    library = MoppinaLibrary(config)
+    tracks = [TRACKS[0].copy(uri='local:track:song%d.mp3' % i,
+                             name='Song %02d' % i, genre='Rock')
+              for i in range(100)]
+    for track in tracks:
+        library.add(track)
+    library.flush()
+
+    def walk(uri):
+        refs = library.browse(uri)
+        assert 0 < len(refs) <= 5
+        for ref in refs:
+            if ref.type == ref.DIRECTORY:
+                for child in walk(ref.uri):
+                    yield child
+            else:
+                yield ref
+
+    expected = sorted(t.uri for t in tracks)
+    for uri in ['local:tracks', 'local:tracks?genre=Rock',
+                'local:tracks?initial=S', ALBUMS[0].uri]:
+        assert sorted(r.uri for r in walk(uri)) == expected
+    assert [r.uri for r in walk(ARTISTS[0].uri)] == [ALBUMS[0].uri]
+
+    library._browse_limit = 1
+    assert len(library.browse('local:genres?page=0&pages=3')) == 1
+    library._browse_limit = 5
+
+    page = library.browse('local:tracks?initial=S')[1]
+    assert page.name == 'Pages 6-10'
+    result = library.search({'track_name': ['song']}, uris=[page.uri])
+    assert sorted(t.name for t in result.tracks) == [
+        'Song %02d' % i for i in range(25, 50)]
+    library.close()
+
+
+def test_stats(library):
+    library.lookup(ALBUMS[0].uri)
+    library.search({'any': ['Track']})
+    library.search({'any': ['Track']})
+
+    stats = library.stats()
+    assert stats['calls']['lookup']['count'] == 1
+    assert stats['calls']['lookup']['queries'] == 1
+    assert stats['calls']['search']['count'] == 2
+    assert stats['search_cache']['hits'] == 1
+    assert stats['slow_queries'] == 0
+    assert list(stats['startup']) == ['imports_ms', 'database_ms',
+                                      'total_ms']
+
+
+def test_slow_query_log(library, caplog):
+    library._connection.slow_query_threshold = 1e-9
+    library.lookup(TRACKS[0].uri)
+
+    assert library.stats()['slow_queries'] == 1
+    assert 'SEARCH' in caplog.text
+
+
+@pytest.mark.parametrize('call', [
+    lambda library: library.lookup(TRACKS[0].uri),
+    lambda library: library.lookup(ALBUMS[0].uri),
+    lambda library: library.lookup(ARTISTS[0].uri),
+    lambda library: library.lookup_many([a.uri for a in ALBUMS]),
+    lambda library: library.browse(ALBUMS[0].uri),
+    lambda library: library.browse(ARTISTS[0].uri),
+    lambda library: library.browse('local:tracks?genre=Rock'),
+    lambda library: library.get_distinct('date', {'genre': ['Rock']})
+])
+def test_query_plans(library, caplog, call):
+    # Log every statement with its query plan
+    library._connection.slow_query_threshold = 1e-9
+    call(library)
+
+    plans = [r.getMessage() for r in caplog.records]
+    assert plans
+    for plan in plans:
+        assert ' SCAN ' not in plan
+        assert 'TEMP B-TREE' not in plan
+
+
+def test_pragmas(library):
+    connection = library._connection
+
+    assert connection.pragma('page_size') == 8192
+    assert connection.pragma('cache_size') == -8192
+    assert connection.pragma('journal_mode') == 'wal'
+    assert connection.pragma('temp_store') == 2
+
+
+def test_sqlite_version(config, monkeypatch):
+    monkeypatch.setattr(peewee.sqlite3, 'sqlite_version_info', (3, 22, 0))
+
+    with pytest.raises(ExtensionError):
+        MoppinaLibrary(config)
+
+
+def test_fast_scan(config):
+    config['local-moppina']['synchronous'] = 'full'
+    library = MoppinaLibrary(config)
+    connection = library._connection
+    assert connection.pragma('synchronous') == 2
+
+    library.add(TRACKS[0])
+    assert connection.pragma('synchronous') == 1
+
+    library.close()
+    assert connection.pragma('synchronous') == 2
+
+
+def test_rescan(config, library, caplog):
+    caplog.set_level('INFO')
+    library.close()
+    library = MoppinaLibrary(config)
+    for track in TRACKS:
+        library.add(track)
+    library.add(TRACKS[0].copy(name='Changed'))
+    library.close()
+
+    assert 'wrote 1 of 31 scanned tracks' in caplog.text
+
+
+def test_clear(library, monkeypatch):
+    written = []
+    library.add(TRACKS[0].copy(name='Changed'))
+    monkeypatch.setattr(library._db, 'upsert_tracks', written.append)
+
+    # The pending tracks are discarded instead of being written
+    assert library.clear()
+    assert library.flush()
+    assert not written
+    assert not list(library.begin())
+
+
+def test_schema_version(config, library):
+    assert library._connection.pragma('user_version') == SCHEMA_VERSION
+    library.close()
+
+    # A current database is only checked for its version
+    library = MoppinaLibrary(config)
+    assert library._connection.query_count == 1
+    library.close()
+
+
+def test_analyze(config, library):
+    connection = library._connection
+    library.close()
+    # The statistics are computed after the first scan
+    stat = ("SELECT stat FROM sqlite_stat1 WHERE tbl = 'track' AND "
+            "idx = 'track_uri_mtime'")
+    assert connection.execute_sql(stat).fetchone() == ('30 1 1',)
+    connection.execute_sql("UPDATE sqlite_stat1 SET stat = '40 1 1' "
+                           "WHERE idx = 'track_uri_mtime'")
+    connection.close()
+
+    # but not refreshed by a scan changing few tracks
+    library = MoppinaLibrary(config)
+    library.add(TRACKS[0].copy(name='Changed'))
+    library.close()
+    assert connection.execute_sql(stat).fetchone() == ('40 1 1',)
+
+
+def test_migrations(config, library):
+    library.close()
+    # Roll back to a database of an older release, without versioning
+    connection = library._connection
+    connection.execute_sql('DROP INDEX track_album_disc_no')
+    schema.drop_fts_triggers(connection)
+    connection.execute_sql('DROP VIEW trackfts_content')
+    connection.execute_sql('DROP TABLE track_artist')
+    connection.pragma('user_version', 0)
+    connection.close()
+
+    library = MoppinaLibrary(config)
+    connection = library._connection
+    assert connection.pragma('user_version') == SCHEMA_VERSION
+    assert 'track_album_disc_no' in [i.name for i in
+                                     connection.get_indexes('track')]
+    assert len(library.search({'any': ['track']}).tracks) == len(TRACKS)
+    # The next scan reads all the files again, storing their artists
+    assert library.mtimes() == dict((t.uri, None) for t in TRACKS)
+    library.close()
+
+
+def test_read_connections(library):
+    query = {'track_name': ['Track']}
+    with library._connection.atomic():
+        library._db.upsert_tracks([TRACKS[0].copy(name='Uncommitted')])
+        # Reads see the last committed data, without waiting for the writer
+        assert len(library.search(query).tracks) == len(TRACKS)
+        assert library.lookup(TRACKS[0].uri)[0].name == TRACKS[0].name
+
+    library._search_cache.clear()
+    assert len(library.search(query).tracks) == len(TRACKS) - 1
+
+
+def test_background_writer(config, monkeypatch):
+    config['local-moppina']['background_writer'] = True
+    library = MoppinaLibrary(config)
+    for track in TRACKS:
+        library.add(track)
+
+    assert library.flush()
+    assert len(list(library.begin())) == len(TRACKS)
+
+    def fail(tracks):
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(library._db, 'upsert_tracks', fail)
+    library.add(TRACKS[0].copy(name='Lost'))
+    library.add(TRACKS[1].copy(name='Lost'))
+
+    assert not library.flush()
+    monkeypatch.undo()
+    library.add(TRACKS[2].copy(name='Changed'))
+    library.close()
+
+    assert library.stats()['write_errors'] == 2
+    assert library.lookup(TRACKS[0].uri)[0].name == TRACKS[0].name
+    assert library.lookup(TRACKS[2].uri)[0].name == 'Changed'
+
+
+def test_memory_index(library):
+    expected = dict((uri, library.lookup(uri)) for uri in
+                    [TRACKS[0].uri, ALBUMS[0].uri, ARTISTS[0].uri])
+    browse = dict((uri, library.browse(uri)) for uri in
+                  [ALBUMS[0].uri, ARTISTS[0].uri])
+
+    library._memory_index = True
+    assert library.load() == len(TRACKS)
+
+    for uri, tracks in expected.items():
+        count, result = count_queries(library, library.lookup, uri)
+        assert count == 0
+        assert sorted(result, key=lambda t: t.uri) == \
+            sorted(tracks, key=lambda t: t.uri)
+    for uri, refs in browse.items():
+        assert count_queries(library, library.browse, uri) == (0, refs)
+
+    # Models are shared between results
+    tracks = library.lookup(ALBUMS[0].uri)
+    assert tracks[0] is library.lookup(TRACKS[0].uri)[0]
+    assert len(set(id(t.album) for t in tracks)) == 1
+
+    # and the index is no longer used once the library changes
+    library.add(TRACKS[0].copy(name='Changed'))
+    library.flush()
+    assert library.lookup(TRACKS[0].uri)[0].name == 'Changed'
+
+
+def test_model_cache(library):
+    tracks = list(library.begin())
+    albums = dict((t.album.uri, t.album) for t in tracks)
+
+    assert len(set(id(t.album) for t in tracks)) == len(ALBUMS)
+    assert all(library.lookup(t.uri)[0].album is albums[t.album.uri]
+               for t in tracks)
+    assert library.lookup(TRACKS[0].uri)[0] is \
+        library.lookup(TRACKS[0].uri)[0]
+
+    library.add(TRACKS[0].copy(album=ALBUMS[0].copy(name='Changed')))
+    library.flush()
+    assert library.lookup(TRACKS[0].uri)[0].album.name == 'Changed'
+
+
+def test_load(config, library):
+    uri = TRACKS[0].uri
+    query = {'track_name': ['Renamed']}
+    assert library.lookup(uri)[0].name == TRACKS[0].name
+    assert not library.search(query).tracks
+    assert library.get_distinct('genre') == {'Rock', 'Jazz'}
+
+    # The library changed by another process, e.g. by mopidy local scan
+    scanner = MoppinaLibrary(config)
+    scanner.add(TRACKS[0].copy(name='Renamed', genre='Blues'))
+    scanner.close()
+
+    library.load()
+    assert library.lookup(uri)[0].name == 'Renamed'
+    assert [t.uri for t in library.search(query).tracks] == [uri]
+    assert library.get_distinct('genre') == {'Rock', 'Jazz', 'Blues'}
+
+
+def test_lookup_many(library):
+    uris = [t.uri for t in TRACKS] + [ALBUMS[0].uri, ARTISTS[1].uri,
+                                      'local:track:missing.mp3', 'invalid']
+    count, result = count_queries(library, library.lookup_many, uris)
+
+    assert count == 3
+    assert list(result) == uris
+    for uri in uris:
+        assert result[uri] == library.lookup(uri)
+
+
+def test_multiple_artists(library):
+    guest = Artist(uri='local:artist:guest', name='Guest')
+    album = ALBUMS[0].copy(artists=[ARTISTS[0], guest])
+    track = TRACKS[0].copy(album=album, artists=[ARTISTS[0], guest],
+                           performers=[guest, ARTISTS[2]])
+    library.add(track)
+    library.flush()
+
+    count, tracks = count_queries(library, library.lookup, track.uri)
+    assert count <= 2
+    assert tracks[0].artists == track.artists
+    assert tracks[0].performers == track.performers
+    assert tracks[0].album.artists == album.artists
+
+    assert track in library.search({'artist': ['guest']}, exact=True).tracks
+    assert track in library.search({'performer': ['Guest']}).tracks
+    assert album in library.search({'albumartist': ['guest']}).albums
+    assert 'Guest' in library.get_distinct('artist')
+
+    library.add(track.copy(artists=[ARTISTS[0]]))
+    library.flush()
+    assert not library.search({'artist': ['guest']}, exact=True).tracks
+    assert library.search({'albumartist': ['guest']}, exact=True).tracks
+
+
+def test_remove(config):
+    config['local-moppina']['vacuum'] = True
+    library = MoppinaLibrary(config)
+    guest = Artist(uri='local:artist:guest', name='Guest')
+    tracks = TRACKS + [Track(uri='local:track:guest.mp3', name='Guest',
+                             album=ALBUMS[0], performers=[guest])]
+    for track in tracks:
+        library.add(track)
+    library.flush()
+
+    # All the tracks of the albums of the first artist
+    removed = [t for t in tracks if t.album.artists == {ARTISTS[0]}]
+    for track in removed:
+        library.remove(track.uri)
+    library.add(removed[0])
+    library.remove(removed[0].uri)
+
+    assert library.flush()
+    assert len(list(library.begin())) == len(tracks) - len(removed)
+    assert library.lookup(removed[0].uri) == []
+    assert not library.search({'album': ['album 0']}).tracks
+    library.close()
+
+    assert [a.name for a in library.browse('local:albums')] == [
+        a.name for a in ALBUMS if a.artists != {ARTISTS[0]}]
+    assert len(library.browse('local:artists')) == len(ARTISTS)
+    assert not library.search({'album': ['album 0']}).albums
+    assert not library.search({'performer': ['guest']}).artists